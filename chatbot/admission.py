@@ -0,0 +1,220 @@
+"""Admission control in front of the chat pipeline: token buckets per session and for the whole server.
+
+Every question that is going to call the API first takes one request and its estimated tokens from its session's
+buckets, then from the global buckets, which are sized to the API quota. A session over its own limits waits for its
+buckets to refill (up to MAX_SESSION_WAIT_SECONDS), so one session can't flood the server. When the global buckets are
+empty, questions wait in a first come, first served queue, and `on_wait` is told their position and estimated wait so
+the user sees it. Questions are only shed when the queue is full or the wait passes MAX_WAIT_SECONDS. Once a question
+is answered, `settle` corrects the buckets by the difference between the estimate and the tokens actually used, and
+gives the request back if the question was answered without a final answer call (e.g. from a cache), so a normal
+back-and-forth isn't throttled by answers that cost next to nothing.
+
+Admitted, throttled, queued and shed counts, the queue length and recent wait times are in `stats()`.
+"""
+import itertools
+import threading
+import time
+from collections import Counter, deque
+
+from chatbot.context import count_tokens
+from chatbot.router import percentile
+
+SESSION_REQUESTS_PER_MINUTE = 6
+SESSION_REQUEST_BURST = 3
+SESSION_TOKENS_PER_MINUTE = 20_000
+SESSION_TOKEN_BURST = 10_000
+GLOBAL_REQUESTS_PER_MINUTE = 300  # Questions; each one makes two or three API calls
+GLOBAL_REQUEST_BURST = 50
+GLOBAL_TOKENS_PER_MINUTE = 200_000
+GLOBAL_TOKEN_BURST = 50_000
+# A question's classification and final calls, prompts and replies included, besides the question itself (which is
+# sent to both). Corrected against the real usage by `settle`.
+ESTIMATED_QUESTION_TOKENS = 2_500
+MAX_QUEUE_LENGTH = 100
+MAX_WAIT_SECONDS = 90
+MAX_SESSION_WAIT_SECONDS = 30
+POLL_SECONDS = 0.5  # How often a waiting question re-checks the buckets and updates its on_wait message
+SESSION_IDLE_SECONDS = 600  # Buckets of sessions idle this long are dropped (a fresh bucket is full anyway)
+
+
+class Shed(Exception):
+    def __init__(self, reason):
+        super().__init__(f"Question shed: {reason}")
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity):
+        self.rate = per_minute / 60
+        self.capacity = capacity
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` (at most the capacity) can be taken."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        self.level -= amount  # May go below zero for amounts over the capacity; the debt is paid by refilling
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class Ticket:
+    def __init__(self, session_id, tokens):
+        self.session_id = session_id
+        self.tokens = tokens
+        self.position = None  # Best queue position seen while waiting, if it had to queue
+        self.waited = 0.0
+
+
+class Admission:
+    def __init__(self):
+        self._requests = TokenBucket(GLOBAL_REQUESTS_PER_MINUTE, GLOBAL_REQUEST_BURST)
+        self._tokens = TokenBucket(GLOBAL_TOKENS_PER_MINUTE, GLOBAL_TOKEN_BURST)
+        self._sessions = {}  # session_id -> (requests bucket, tokens bucket, last used)
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._ticket_ids = itertools.count()
+        self._stats = Counter()
+        self._waits = deque(maxlen=500)
+
+    @staticmethod
+    def estimate_tokens(prompt):
+        return ESTIMATED_QUESTION_TOKENS + 2 * count_tokens(prompt)
+
+    def _session_buckets(self, session_id, now):
+        for stale in [s for s, (_, _, used) in self._sessions.items() if now - used > SESSION_IDLE_SECONDS]:
+            del self._sessions[stale]
+        requests, tokens, _ = self._sessions.get(session_id) or (
+            TokenBucket(SESSION_REQUESTS_PER_MINUTE, SESSION_REQUEST_BURST),
+            TokenBucket(SESSION_TOKENS_PER_MINUTE, SESSION_TOKEN_BURST), now)
+        self._sessions[session_id] = (requests, tokens, now)
+        return requests, tokens
+
+    def _shed(self, reason):
+        self._stats[f"shed_{reason}"] += 1
+        raise Shed(reason)
+
+    def admit(self, session_id, tokens, on_wait=lambda position, seconds: None):
+        """Block until the question may call the API and return its Ticket, calling `on_wait(position, seconds)`
+        while it waits (position is None while the session waits for its own limits). Raises Shed."""
+        ticket = Ticket(session_id, tokens)
+        start = time.monotonic()
+        self._wait_for_session(ticket, on_wait)
+        self._wait_in_queue(ticket, on_wait)
+        ticket.waited = time.monotonic() - start
+        with self._condition:
+            self._stats["admitted"] += 1
+            self._waits.append(ticket.waited)
+        return ticket
+
+    def _wait_for_session(self, ticket, on_wait):
+        throttled = False
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                requests, tokens = self._session_buckets(ticket.session_id, now)
+                wait = max(requests.wait_time(1, now), tokens.wait_time(ticket.tokens, now))
+                if wait == 0:
+                    requests.take(1)
+                    tokens.take(ticket.tokens)
+                    return
+                if wait > MAX_SESSION_WAIT_SECONDS:
+                    self._shed("session_limit")
+                if not throttled:
+                    self._stats["session_throttled"] += 1
+                    throttled = True
+            on_wait(None, wait)
+            time.sleep(min(wait, POLL_SECONDS))
+
+    def _wait_in_queue(self, ticket, on_wait):
+        ticket_id = next(self._ticket_ids)
+        deadline = time.monotonic() + MAX_WAIT_SECONDS
+        admitted = shed = False
+        with self._condition:
+            if len(self._queue) >= MAX_QUEUE_LENGTH:
+                self._give_back_session(ticket)
+                self._shed("queue_full")
+            self._queue.append(ticket_id)
+        try:
+            while True:
+                with self._condition:
+                    now = time.monotonic()
+                    wait = max(self._requests.wait_time(1, now), self._tokens.wait_time(ticket.tokens, now))
+                    position = self._queue.index(ticket_id) + 1
+                    if position == 1 and wait == 0:
+                        self._requests.take(1)
+                        self._tokens.take(ticket.tokens)
+                        admitted = True
+                        return
+                    if now >= deadline:
+                        shed = True
+                        self._give_back_session(ticket)
+                        self._shed("timeout")
+                    if ticket.position is None:
+                        self._stats["queued"] += 1
+                    ticket.position = min(position, ticket.position or position)
+                    # Everyone ahead needs roughly as long as the head does
+                    estimate = wait * position if wait else POLL_SECONDS * position
+                on_wait(position, estimate)
+                with self._condition:
+                    self._condition.wait(min(max(wait, 0.05), POLL_SECONDS))
+        finally:
+            # Also when the run is interrupted while waiting, e.g. the user asked something else meanwhile
+            with self._condition:
+                self._queue.remove(ticket_id)
+                self._condition.notify_all()
+                if not admitted and not shed:
+                    self._give_back_session(ticket)
+                    self._stats["abandoned"] += 1
+
+    def _give_back_session(self, ticket, tokens=True):
+        entry = self._sessions.get(ticket.session_id)
+        if entry is not None:
+            entry[0].give_back(1)
+            if tokens:
+                entry[1].give_back(ticket.tokens)
+
+    def settle(self, ticket, used_tokens, refund_request=False):
+        """Correct the buckets once the question is answered; `used_tokens` is what its API calls actually used.
+        With `refund_request` the question's request is given back too."""
+        difference = used_tokens - ticket.tokens
+        with self._condition:
+            if refund_request:
+                self._requests.give_back(1)
+                self._give_back_session(ticket, tokens=False)
+                self._stats["refunded"] += 1
+            for bucket in [self._tokens] + [entry[1] for entry in [self._sessions.get(ticket.session_id)] if entry]:
+                if difference > 0:
+                    bucket.take(difference)
+                else:
+                    bucket.give_back(-difference)
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            now = time.monotonic()
+            self._requests.wait_time(0, now)  # Refills both buckets up to now
+            self._tokens.wait_time(0, now)
+            result = {
+                **self._stats,
+                "queue_length": len(self._queue),
+                "sessions": len(self._sessions),
+                "global_requests_available": round(self._requests.level, 1),
+                "global_tokens_available": round(self._tokens.level),
+            }
+            if self._waits:
+                result["wait_p50"] = percentile(self._waits, 50)
+                result["wait_p95"] = percentile(self._waits, 95)
+            return result
+
+
+admission = Admission()
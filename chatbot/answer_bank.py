@@ -0,0 +1,279 @@
+"""Pre-generated answers to every phase's potential_questions, served before the live pipeline.
+
+`python -m chatbot.answer_bank` walks every project, phase and language in LANGUAGES and answers each of the phase's
+potential_questions with the same context and final prompt as the live pipeline, at most --concurrency calls at a
+time. For the other languages the question is translated first, so that users asking in that language match it. The
+answers go into a small SQLite file (ANSWER_BANK_PATH), indexed by project, phase and language:
+
+    python -m chatbot.answer_bank --concurrency 8           # against the API, needs OPENAI_API_KEY
+    python -m chatbot.answer_bank --stub                     # against the in-process loadtest stub, into STUB_PATH
+
+At runtime `answer_bank.get` matches a prompt to the bank's questions for the same project, phase and language by
+TF-IDF cosine similarity. Answers generated from an older version of a project file are ignored. Rerunning the job
+replaces the answers it generated and keeps the existing ones for questions that failed or were outside its
+--project / --language selection.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from chatbot import llm
+from chatbot.answer_cache import normalize_question, question_terms, idf_weights, tfidf_vector, cosine
+from chatbot.pipeline import final_context_prompt, final_messages
+from chatbot.project_store import project_store, get_project, PROJECT_CATALOG
+from chatbot.retrieval import retrieve_context
+from prompts import translation_prompt
+
+ANSWER_BANK_PATH = os.environ.get("ANSWER_BANK_PATH", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "project_data", "answer_bank.sqlite3"))
+STUB_PATH = os.path.join(tempfile.gettempdir(), "answer_bank.stub.sqlite3")  # Canned answers never reach real users
+LANGUAGES = ["English", "Hindi", "Hinglish"]
+SIMILARITY_THRESHOLD = 0.75  # Stricter than a paraphrase in the answer cache: these prompts haven't been rewritten
+DEFAULT_CONCURRENCY = 4
+BANK_CATEGORY = ""  # The questions aren't classified, so the final prompt gets no category
+
+_source_hashes = {}  # project_key -> (store signature, sha256 of the project file)
+
+
+def project_source_hash(project_key):
+    signature = project_store.signature(project_key)
+    entry = _source_hashes.get(project_key)
+    if entry is None or entry[0] != signature:
+        with open(project_store.path(project_key), "rb") as file:
+            entry = (signature, hashlib.sha256(file.read()).hexdigest())
+        _source_hashes[project_key] = entry
+    return entry[1]
+
+
+class AnswerBank:
+    def __init__(self, path=ANSWER_BANK_PATH, similarity_threshold=SIMILARITY_THRESHOLD):
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._signature = None
+        # (project_key, project_phase, language) -> (idf, [(vector, question, answer, source_hash)])
+        self._partitions = {}
+        self._stats = Counter()
+
+    def _load(self):
+        # Re-read whenever the file changes, e.g. after the batch job ran again
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._signature, self._partitions = None, {}
+            return
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            rows = connection.execute("SELECT project_key, project_phase, language, question, answer, source_hash "
+                                      "FROM answers").fetchall()
+        finally:
+            connection.close()
+        grouped = {}
+        for project_key, project_phase, language, question, answer, source_hash in rows:
+            grouped.setdefault((project_key, project_phase, language), []).append(
+                (question_terms(normalize_question(question)), question, answer, source_hash))
+        self._partitions = {}
+        for partition, entries in grouped.items():
+            idf = idf_weights([terms for terms, *_ in entries])
+            self._partitions[partition] = (idf, [(tfidf_vector(terms, idf), *rest) for terms, *rest in entries])
+        self._signature = signature
+
+    def get(self, project_key, project_phase, language, prompt):
+        """Return (question, answer, similarity) for the banked question closest to `prompt`, or None."""
+        partition = (project_key, project_phase.lower(), language.lower())
+        with self._lock:
+            self._load()
+            index = self._partitions.get(partition)
+            if index is None:
+                self._stats["misses"] += 1
+                return None
+            idf, entries = index
+            query = tfidf_vector(question_terms(normalize_question(prompt)), idf)
+            best, best_score = None, 0.0
+            for vector, question, answer, source_hash in entries:
+                score = cosine(query, vector)
+                if score > best_score:
+                    best, best_score = (question, answer, source_hash), score
+            if best is None or best_score < self.similarity_threshold:
+                self._stats["misses"] += 1
+                return None
+            if best[2] != project_source_hash(project_key):
+                self._stats["stale"] += 1
+                return None
+            self._stats["hits"] += 1
+            return best[0], best[1], best_score
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = sum(stats.values())
+            stats["hit_rate"] = stats.get("hits", 0) / lookups if lookups else 0.0
+            return stats
+
+
+answer_bank = AnswerBank()
+
+
+def catalog_entries(project_keys=None):
+    """Yield (grade, project_name, project_key) for the catalog's projects that have a project file."""
+    available = set(project_store.project_keys())
+    for grade, projects in PROJECT_CATALOG.items():
+        for project_name, details in projects.items():
+            key = details["key"]
+            if key in available and (project_keys is None or key in project_keys):
+                yield grade, project_name, key
+
+
+def bank_jobs(project_keys=None, languages=LANGUAGES):
+    """Everything the batch job answers, as dicts of final_context_prompt arguments plus the question."""
+    for grade, project_name, project_key in catalog_entries(project_keys):
+        data = get_project(project_key)
+        for phase, details in data.get("phases", {}).items():
+            for question in details.get("potential_questions", []):
+                for language in languages:
+                    yield dict(project_key=project_key, grade=grade, project_name=project_name,
+                               project_phase=details.get("key", phase.title()),
+                               project_driving_question=data.get("driving_question", ""),
+                               phase_overview=details.get("summary", ""), language=language, question=question)
+
+
+async def answer_job(client, model_kwargs, semaphore, job):
+    async with semaphore:
+        question = job["question"]
+        if job["language"] != "English":
+            response = await llm.acreate(client, "translation", **model_kwargs, messages=[
+                {"role": "system", "content": translation_prompt.format(language=job["language"])},
+                {"role": "user", "content": question},
+            ])
+            question = response.choices[0].message.content.strip()
+        phase_instructions, supplemental_resources = retrieve_context(job["project_key"], job["project_phase"],
+                                                                      job["question"])
+        context_prompt = final_context_prompt(job["grade"], job["project_name"], job["project_phase"],
+                                              job["language"], BANK_CATEGORY,
+                                              job["project_driving_question"], job["phase_overview"],
+                                              phase_instructions, supplemental_resources)
+        response = await llm.acreate(client, "final", **model_kwargs, messages=final_messages(context_prompt, question))
+        return (job["project_key"], job["project_phase"].lower(), job["language"].lower(), question,
+                response.choices[0].message.content.strip(), project_source_hash(job["project_key"]), time.time(),
+                job["question"])
+
+
+async def generate(api_key, model, jobs, concurrency):
+    """Answer every job with at most `concurrency` calls in flight, on `model` or else the routed models.
+    Returns (rows, failures)."""
+    model_kwargs = {"model": model} if model else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    client = llm.async_client(api_key)
+    results = await asyncio.gather(*(answer_job(client, model_kwargs, semaphore, job) for job in jobs),
+                                   return_exceptions=True)
+    rows = [r for r in results if not isinstance(r, BaseException)]
+    failures = [(job, r) for job, r in zip(jobs, results) if isinstance(r, BaseException)]
+    return rows, failures
+
+
+def _row_key(project_key, project_phase, language, source_question):
+    return project_key, project_phase.lower(), language.lower(), source_question
+
+
+def read_rows(path):
+    """The rows of an existing bank file, or [] if there is none."""
+    if not os.path.exists(path):
+        return []
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        try:
+            return connection.execute("SELECT * FROM answers").fetchall()
+        except sqlite3.OperationalError:  # No answers table
+            return []
+    finally:
+        connection.close()
+
+
+def merge_rows(existing, rows, jobs):
+    """`rows` plus the existing rows for every job that didn't produce one this time, because it failed or wasn't
+    selected. Banks from before the source_question column only had English questions matched by their own text."""
+    answered = {_row_key(*row[:3], row[7]) for row in rows}
+    selected = {(job["project_key"], job["language"].lower()) for job in jobs}
+    failed = {_row_key(job["project_key"], job["project_phase"], job["language"], job["question"]) for job in jobs} \
+        - answered
+    kept = []
+    for row in existing:
+        row = (*row[:7], row[7] if len(row) > 7 else row[3])
+        key = _row_key(*row[:3], row[7])
+        if key in failed or (key not in answered and (row[0], row[2]) not in selected):
+            kept.append(row)
+    return kept + rows
+
+
+def write_bank(path, rows):
+    # Written to a temporary file and swapped in, so running apps never read a half-written bank
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript("""
+            CREATE TABLE answers (
+                project_key TEXT NOT NULL,
+                project_phase TEXT NOT NULL,
+                language TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                source_hash TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                source_question TEXT NOT NULL
+            );
+            CREATE INDEX answers_partition ON answers (project_key, project_phase, language);
+        """)
+        connection.executemany("INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-generate answers to every phase's potential_questions.")
+    parser.add_argument("--output", help=f"Answer bank file to write (default: {ANSWER_BANK_PATH}, or {STUB_PATH} "
+                                          f"with --stub)")
+    parser.add_argument("--model", help="Use this model for every call instead of the routed per-stage models")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Calls in flight at most")
+    parser.add_argument("--project", action="append", dest="projects", help="Only this project key (repeatable)")
+    parser.add_argument("--language", action="append", dest="languages", choices=LANGUAGES,
+                        help="Only this language (repeatable)")
+    parser.add_argument("--stub", action="store_true", help="Answer with the in-process loadtest stub server")
+    args = parser.parse_args(argv)
+
+    api_key = os.environ.get("OPENAI_API_KEY")
+    output = args.output or (STUB_PATH if args.stub else ANSWER_BANK_PATH)
+    if args.stub:
+        from loadtest import stub_server
+
+        server = stub_server.start_in_thread(port=0, latency={stage: (0, 0) for stage in stub_server.DEFAULT_LATENCY},
+                                             token_delay=0)
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        api_key = "stub"
+
+    jobs = list(bank_jobs(args.projects, args.languages or LANGUAGES))
+    start = time.perf_counter()
+    rows, failures = asyncio.run(generate(api_key, args.model, jobs, args.concurrency))
+    for job, error in failures:
+        print(f"Failed: {job['project_key']} / {job['project_phase']} / {job['language']}: {job['question']}: {error}")
+    if rows:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        write_bank(output, merge_rows(read_rows(output), rows, jobs))
+    print(f"Answered {len(rows)} of {len(jobs)} questions in {time.perf_counter() - start:.1f}s, wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""On-disk cache of final answers, shared by every session on the server.
+
+Answers are keyed by (project, phase, language, normalized rewritten prompt). A lookup that misses the exact key falls
+back to TF-IDF cosine similarity against the other questions cached for the same project, phase and language, so
+paraphrases hit too. Entries expire after a TTL and the least recently used ones are evicted past MAX_ENTRIES.
+"""
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache")
+CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", os.path.join(CACHE_DIR, "answer_cache.sqlite3"))
+TTL_SECONDS = 7 * 24 * 3600
+MAX_ENTRIES = 5000
+SIMILARITY_THRESHOLD = 0.8
+
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "am", "was", "were", "be", "to", "of", "in", "on", "for", "and", "or", "it", "this",
+    "that", "my", "me", "i", "we", "our", "you", "your", "do", "does", "can", "could", "should", "would", "will",
+    "please", "with", "at", "by", "from", "as", "so", "about", "hai", "ka", "ki", "ke", "ko", "mein", "se",
+    "kya", "है", "का", "की", "के", "को", "में", "से", "क्या",
+}
+
+_TOKEN_PATTERN = re.compile(r"[\w\u0900-\u097F]+")  # Word characters, plus Devanagari vowel signs
+
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def normalize_question(text):
+    return " ".join(tokenize(text))
+
+
+def question_terms(text):
+    return [t for t in tokenize(text) if t not in STOPWORDS] or tokenize(text)
+
+
+def idf_weights(documents):
+    document_frequency = Counter(t for terms in documents for t in set(terms))
+    return {t: math.log((1 + len(documents)) / (1 + df)) + 1 for t, df in document_frequency.items()}
+
+
+def tfidf_vector(terms, idf):
+    counts = Counter(terms)
+    vector = {t: (1 + math.log(c)) * idf.get(t, 1.0) for t, c in counts.items()}
+    norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+    return {t: w / norm for t, w in vector.items()}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(w * b.get(t, 0.0) for t, w in a.items())
+
+
+class AnswerCache:
+    def __init__(self, path=CACHE_PATH, ttl_seconds=TTL_SECONDS, max_entries=MAX_ENTRIES,
+                 similarity_threshold=SIMILARITY_THRESHOLD):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._connection = None
+        self._indexes = {}  # (project_key, project_phase, language) -> (idf, [(key, vector)])
+        self._stats = Counter()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    project_key TEXT NOT NULL,
+                    project_phase TEXT NOT NULL,
+                    language TEXT NOT NULL,
+                    normalized_prompt TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    category TEXT,
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS answers_partition ON answers (project_key, project_phase, language);
+                CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used_at);
+            """)
+        return self._connection
+
+    @staticmethod
+    def _key(project_key, project_phase, language, normalized_prompt):
+        raw = "\x1f".join([project_key, project_phase.lower(), language.lower(), normalized_prompt])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _partition_index(self, connection, partition):
+        index = self._indexes.get(partition)
+        if index is None:
+            rows = connection.execute(
+                "SELECT key, normalized_prompt FROM answers WHERE project_key = ? AND project_phase = ? "
+                "AND language = ? AND created_at >= ?", (*partition, time.time() - self.ttl_seconds)).fetchall()
+            documents = [(key, question_terms(text)) for key, text in rows]
+            idf = idf_weights([terms for _, terms in documents])
+            index = (idf, [(key, tfidf_vector(terms, idf)) for key, terms in documents])
+            self._indexes[partition] = index
+        return index
+
+    def get(self, project_key, project_phase, language, prompt):
+        """Return (answer, category) for this question or a close paraphrase of it, or None."""
+        normalized = normalize_question(prompt)
+        partition = (project_key, project_phase.lower(), language.lower())
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            key = self._key(*partition, normalized)
+            row = connection.execute("SELECT key, answer, category, tokens FROM answers WHERE key = ? AND created_at >= ?",
+                                     (key, now - self.ttl_seconds)).fetchone()
+            kind = "exact_hits"
+            if row is None:
+                idf, vectors = self._partition_index(connection, partition)
+                query = tfidf_vector(question_terms(normalized), idf)
+                best_key, best_score = None, 0.0
+                for candidate_key, vector in vectors:
+                    score = cosine(query, vector)
+                    if score > best_score:
+                        best_key, best_score = candidate_key, score
+                if best_key is not None and best_score >= self.similarity_threshold:
+                    row = connection.execute("SELECT key, answer, category, tokens FROM answers WHERE key = ?",
+                                             (best_key,)).fetchone()
+                kind = "similar_hits"
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            connection.execute("UPDATE answers SET last_used_at = ?, hits = hits + 1 WHERE key = ?", (now, row[0]))
+            connection.commit()
+            self._stats[kind] += 1
+            self._stats["tokens_saved"] += row[3]
+            return row[1], row[2]
+
+    def put(self, project_key, project_phase, language, prompt, answer, category=None, tokens=0):
+        """Cache an answer. `tokens` is what producing it cost upstream, counted as saved on every later hit."""
+        normalized = normalize_question(prompt)
+        partition = (project_key, project_phase.lower(), language.lower())
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO answers (key, project_key, project_phase, language, normalized_prompt, prompt, "
+                "answer, category, tokens, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._key(*partition, normalized), *partition, normalized, prompt, answer, category, tokens or 0, now,
+                 now))
+            connection.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+            connection.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+            connection.commit()
+            self._indexes.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats.get("exact_hits", 0) + stats.get("similar_hits", 0) + stats.get("misses", 0)
+            stats["lookups"] = lookups
+            stats["hit_rate"] = (lookups - stats.get("misses", 0)) / lookups if lookups else 0.0
+            if self._connection is not None:
+                stats["entries"] = self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            return stats
+
+
+answer_cache = AnswerCache()
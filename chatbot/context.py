@@ -0,0 +1,105 @@
+"""Token counting, compact serialization and per-stage token budgets for the prompts we send.
+
+Tokens are counted locally with tiktoken when it is installed and its encoding can be loaded, and estimated at ~4
+characters per token otherwise. tiktoken downloads the encoding on first use; on hosts without network access, cache it
+ahead of time and point TIKTOKEN_CACHE_DIR at the cache:
+
+    TIKTOKEN_CACHE_DIR=/path/to/cache python -c "import tiktoken; tiktoken.get_encoding('cl100k_base')"
+`fit_context` fills a context template and trims it to the stage's budget, dropping the lowest-priority material
+first: supplemental resources, then the oldest past messages, then the last of the phase instruction chunks.
+"""
+import functools
+import math
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKENIZER_ENCODING = "cl100k_base"  # gpt-3.5-turbo and gpt-4
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators added around every chat message
+REPLY_PRIMING_TOKENS = 3
+
+# Budget for the context system message plus past messages of each call, excluding the fixed instructions
+STAGE_TOKEN_BUDGETS = {
+    "validity": 700,
+    "classification": 700,
+    "category": 500,
+    "final": 800,
+}
+CHUNK_SEPARATOR = "\n\n"
+NO_SUPPLEMENTAL_RESOURCES = "No supplemental resources available."
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception:  # Usually no network to download the encoding, and no TIKTOKEN_CACHE_DIR with it
+        return None
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages) + REPLY_PRIMING_TOKENS
+
+
+def compact(value):
+    """Render YAML data as short plain text: nested lists as "- " lines, mappings as "key: value", whitespace
+    collapsed, and no Python repr quotes or escapes."""
+    if isinstance(value, dict):
+        return "; ".join(f"{k}: {compact(v)}" for k, v in value.items())
+    if isinstance(value, list):
+        return "\n".join(f"- {compact(v)}" for v in value)
+    return " ".join(str(value).split())
+
+
+HISTORY_ROLES = {"summary": "earlier in the conversation", "user": "user", "assistant": "assistant"}
+
+
+def compact_history(past_messages):
+    # One "role: content" line per message. System prompts are sent separately, so they are left out here
+    return "\n".join(f"{HISTORY_ROLES[m['role']]}: {compact(m['content'])}" for m in past_messages
+                     if m.get("role") in HISTORY_ROLES)
+
+
+def fit_context(stage, template, fields, past_messages=()):
+    """Format `template` with `fields` and trim it, together with `past_messages`, to STAGE_TOKEN_BUDGETS[stage].
+
+    Returns (context, past_messages) where past_messages keeps the most recent messages that fit."""
+    budget = STAGE_TOKEN_BUDGETS[stage]
+    fields = {k: v if isinstance(v, str) else compact(v) for k, v in fields.items()}
+    history = [m for m in past_messages if m.get("role") in HISTORY_ROLES]
+    supplemental = fields.get("supplemental_resources")
+    instructions = fields["phase_instructions"].split(CHUNK_SEPARATOR) if fields.get("phase_instructions") else []
+
+    def render():
+        values = {**fields, "phase_instructions": CHUNK_SEPARATOR.join(instructions)}
+        if "supplemental_resources" in fields:
+            values["supplemental_resources"] = supplemental or NO_SUPPLEMENTAL_RESOURCES
+        return template.format(**values)
+
+    context = render()
+    used = count_tokens(context) + count_tokens(compact_history(history))
+    while used > budget:
+        if supplemental:
+            supplemental = None
+        elif history:
+            history = history[1:]
+        elif len(instructions) > 1:
+            instructions = instructions[:-1]
+        else:
+            break  # Only the essentials are left
+        context = render()
+        used = count_tokens(context) + count_tokens(compact_history(history))
+    return context, history
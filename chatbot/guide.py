@@ -0,0 +1,115 @@
+"""Pre-rendered project guide pages.
+
+Each (project, phase) guide is compiled once into a single markdown/HTML document (collapsible sections are
+<details> blocks) and cached in memory and under .cache/guides/, keyed by the YAML file's mtime and size, so a rerun
+emits one markdown element per phase instead of a widget per line.
+"""
+import hashlib
+import os
+import threading
+
+from chatbot.project_store import project_store
+
+GUIDE_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "guides")
+GUIDE_FORMAT_VERSION = 1  # Bump when the rendered layout changes, to discard old files on disk
+
+SECTION_INFO = [
+    ("🧰 Tools & Materials", "tools_materials"),
+    ("🎨 Student Outputs", "student_output"),
+    ("💬 Potential Questions", "potential_questions"),
+    ("🧑‍🏫 Facilitation Notes", "facilitation_notes"),
+    ("📋 General Guidelines", "general_guidelines"),
+]
+
+
+def _details(title, body, expanded=False):
+    return f"<details{' open' if expanded else ''}>\n<summary><b>{title}</b></summary>\n\n{body}\n\n</details>\n"
+
+
+def _bullets(items):
+    return "\n".join(f"- {item}" for item in items)
+
+
+def render_phase(details):
+    """Markdown for one phase, laid out like the original widget-by-widget guide."""
+    parts = [f"### ⏱️ Duration: `{details.get('duration', 'N/A')}`"]
+
+    if summary := details.get("summary"):
+        parts.append(_details("📝 Summary", f"<div style='font-size: 1.1em; line-height: 1.6;'>{summary}</div>",
+                              expanded=True))
+
+    if hook := details.get("story_hook"):
+        lines = []
+        if isinstance(hook, list):
+            for item in hook:
+                if isinstance(item, dict):
+                    lines += [f"**{k.capitalize()}:** {v}" for k, v in item.items()]
+                else:
+                    lines.append(f"- {item}")
+        parts.append(_details("🎣 Story Hook", "\n\n".join(lines)))
+
+    if activities := details.get("activities"):
+        lines = []
+        for act in activities:
+            lines += [f"#### 🔹 {act.get('name')}", f"{act.get('description', '')}"]
+            if steps := act.get("steps"):
+                lines += ["**👣 Steps:**", _bullets(steps)]
+            if simplifications := act.get("simplifications"):
+                lines += ["**🧩 Simplifications:**", _bullets(simplifications)]
+            if extensions := act.get("extensions"):
+                lines += ["**🚀 Extensions:**", _bullets(extensions)]
+            lines.append("---")
+        parts.append(_details("🎯 Activities", "\n\n".join(lines)))
+
+    for section_title, field_key in SECTION_INFO:
+        if items := details.get(field_key):
+            parts.append(_details(section_title, _bullets(items)))
+
+    return "\n\n".join(parts)
+
+
+class GuideCache:
+    def __init__(self, cache_dir=GUIDE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._entries = {}  # (project_key, phase) -> (signature, markdown)
+        self._lock = threading.Lock()
+
+    def _path(self, project_key, phase, signature):
+        digest = hashlib.sha256(repr((GUIDE_FORMAT_VERSION, signature)).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{project_key}.{phase}.{digest}.md")
+
+    def get(self, project_key, phase):
+        """Return the rendered markdown for one phase of a project."""
+        signature = project_store.signature(project_key)
+        entry = self._entries.get((project_key, phase))
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        with self._lock:
+            path = self._path(project_key, phase, signature)
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    markdown = file.read()
+            except OSError:
+                details = project_store.get(project_key).get("phases", {}).get(phase, {})
+                markdown = render_phase(details)
+                self._write(project_key, phase, path, markdown)
+            self._entries[(project_key, phase)] = (signature, markdown)
+        return markdown
+
+    def _write(self, project_key, phase, path, markdown):
+        # Old renders of this phase are removed, so the directory holds one file per (project, phase)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            prefix = f"{project_key}.{phase}."
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(prefix) and name.count(".") == 3:
+                    os.remove(os.path.join(self.cache_dir, name))
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(markdown)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+
+guide_cache = GuideCache()
@@ -0,0 +1,366 @@
+"""One pooled OpenAI client per process, with per-stage timeouts, bounded retries and a circuit breaker.
+
+Every chat completion goes through `create` / `acreate`, which take the stage's model and parameters from
+chatbot.router and report each call's latency back to it. The async client lives on one background event loop, so its
+keep-alive connections outlive each rerun's asyncio.run(); `acreate` hands each call over to that loop. Transient
+failures (connection errors, timeouts, 429s and 5xx) are retried a few times with jittered exponential backoff. After
+CIRCUIT_FAILURE_THRESHOLD requests in a row still fail after their retries, the circuit opens and calls fail fast with
+UpstreamUnavailable for CIRCUIT_COOLDOWN_SECONDS, then a single trial call (without retries) is let through to probe
+whether the upstream has recovered. Other API errors (400s, 401s) are not retried but count as failures too; a call that
+is cancelled, such as a discarded speculative answer, counts as neither.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+
+import httpx  # Installed with openai; stream reads can raise its errors unwrapped
+
+from openai import (OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS,
+                    DEFAULT_TIMEOUT, APIError, APIConnectionError, APITimeoutError, RateLimitError,
+                    InternalServerError)
+
+from chatbot import tracing
+from chatbot.router import router
+
+# Seconds. Streamed answers only have to produce their first chunk within the timeout of the "final" stage
+STAGE_TIMEOUTS = {"validity": 15, "classification": 15, "category": 10, "final": 30, "translation": 15}
+CONNECT_TIMEOUT = 5
+MAX_CONNECTIONS = 50
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 60
+MAX_RETRIES = 2
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 4
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 30
+
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+# What reading a stream that already started can raise when the connection or the upstream fails
+STREAM_ERRORS = (APIError, httpx.HTTPError)
+
+
+class UpstreamUnavailable(Exception):
+    """The model API is failing or the circuit breaker is open; show a degraded answer instead."""
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown_seconds=CIRCUIT_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.cooldown_seconds else "open"
+
+    def allow(self):
+        """Falsy if the call has to be rejected, "trial" for the one call let through while half-open (which must
+        end with record_success, record_failure or release_trial), True otherwise."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return "trial"
+            return False
+
+    def release_trial(self):
+        # For a trial call that ended without saying anything about the upstream, e.g. because it was cancelled
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    _count("circuit_opened")
+                self._opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+_metrics = Counter()
+_metrics_lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with _metrics_lock:
+        _metrics[key] += n
+
+
+def _trace(event_name, info):
+    # httpcore trace events; a completed TCP connect means the pool had no idle keep-alive connection to reuse
+    if event_name == "connection.connect_tcp.complete":
+        _count("connections_opened")
+
+
+async def _atrace(event_name, info):
+    _trace(event_name, info)
+
+
+def _on_request(request):
+    request.extensions["trace"] = _trace
+    _count("http_requests")
+
+
+async def _aon_request(request):
+    request.extensions["trace"] = _atrace
+    _count("http_requests")
+
+
+def _on_response(response):
+    _count(f"http_{response.status_code // 100}xx")
+
+
+async def _aon_response(response):
+    _on_response(response)
+
+
+def _http_client_kwargs():
+    limits = type(DEFAULT_CONNECTION_LIMITS)(max_connections=MAX_CONNECTIONS,  # httpx.Limits
+                                             max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                             keepalive_expiry=KEEPALIVE_EXPIRY)
+    return dict(limits=limits)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(api_key):
+    """The process-wide client, so every session and rerun shares one keep-alive connection pool."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                http_client = DefaultHttpxClient(**_http_client_kwargs(),
+                                                 event_hooks={"request": [_on_request], "response": [_on_response]})
+                _client = OpenAI(api_key=api_key, max_retries=0, http_client=http_client)
+    return _client
+
+
+_async_client = None
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _shared_loop():
+    # Async connections belong to the event loop that opened them, and every rerun's asyncio.run() makes a new one,
+    # so the async client lives on one long-lived loop in a background thread and its calls are sent there
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="openai-event-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+async def _on_shared_loop(coroutine):
+    loop = _shared_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coroutine
+    # Cancelling the wrapper cancels the call on the shared loop too
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+
+
+def _stream_failed(stage, error):
+    # The request is lost once its stream broke; chunks already shown can't be retried
+    _count("timeouts" if isinstance(error, (APITimeoutError, httpx.TimeoutException)) else "errors")
+    breaker.record_failure()
+    return UpstreamUnavailable(f"The {stage} stream failed: {error}")
+
+
+class _GuardedStream:
+    """A sync streamed response whose read errors surface as UpstreamUnavailable."""
+
+    def __init__(self, stream, stage):
+        self._stream = stream
+        self._stage = stage
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except STREAM_ERRORS as e:
+            raise _stream_failed(self._stage, e) from e
+
+    def close(self):
+        self._stream.close()
+
+
+class _SharedLoopStream:
+    """A streamed response living on the shared loop, iterated from another loop. Read errors surface as
+    UpstreamUnavailable."""
+
+    def __init__(self, stream, stage):
+        self._stream = stream
+        self._stage = stage
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await _on_shared_loop(self._stream.__anext__())
+        except STREAM_ERRORS as e:
+            raise _stream_failed(self._stage, e) from e
+        except asyncio.CancelledError:
+            # Give the connection back to the pool instead of leaving a half-read response on it
+            asyncio.run_coroutine_threadsafe(self._stream.close(), _shared_loop())
+            raise
+
+    async def close(self):
+        await _on_shared_loop(self._stream.close())
+
+
+def async_client(api_key):
+    """The process-wide async client, so every session and rerun shares one keep-alive connection pool. It runs on a
+    background event loop; `acreate` can be awaited from any other loop and hands the call over."""
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                http_client = DefaultAsyncHttpxClient(**_http_client_kwargs(),
+                                                      event_hooks={"request": [_aon_request],
+                                                                   "response": [_aon_response]})
+                _async_client = AsyncOpenAI(api_key=api_key, max_retries=0, http_client=http_client)
+    return _async_client
+
+
+def _timeout(stage):
+    return type(DEFAULT_TIMEOUT)(STAGE_TIMEOUTS[stage], connect=CONNECT_TIMEOUT)  # httpx.Timeout
+
+
+def _retry_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))  # Full jitter
+
+
+def _check_circuit(stage):
+    allowed = breaker.allow()
+    if not allowed:
+        _count("circuit_rejected")
+        raise UpstreamUnavailable(f"Circuit open, skipping the {stage} call")
+    return allowed == "trial"
+
+
+def _record_error(stage, error, attempt, trial):
+    # The breaker counts failed requests, not attempts: a request fails once its retries are used up, the circuit
+    # opened meanwhile, or it was the half-open trial (which isn't retried)
+    _count("timeouts" if isinstance(error, APITimeoutError) else "errors")
+    if trial or attempt == MAX_RETRIES or breaker.state == "open":
+        breaker.record_failure()
+        raise UpstreamUnavailable(f"The {stage} call failed: {error}") from error
+    _count("retries")
+
+
+def _routed(stage, kwargs):
+    # The router picks the stage's model and parameters; arguments given by the caller take precedence
+    request = router.request(stage) if "model" not in kwargs else router.stage_params.get(stage, {})
+    return {**request, **kwargs}
+
+
+def _observe(stage, model, start, error=None):
+    # Timeouts count as (very slow) latencies, other failures say nothing about the model's speed
+    if error is None or isinstance(error, APITimeoutError):
+        router.observe(stage, model, time.perf_counter() - start)
+
+
+def create(client, stage, **kwargs):
+    """client.chat.completions.create(**kwargs) with the stage's routed model and parameters, timeout, retries and the
+    circuit breaker. Non-streamed calls are traced as a `stage` span; streamed ones are traced by the caller, which
+    sees them end."""
+    kwargs = _routed(stage, kwargs)
+    if kwargs.get("stream"):
+        return _create(client, stage, **kwargs)
+    with tracing.span(stage, model=kwargs["model"]) as stage_span:
+        response = _create(client, stage, **kwargs)
+        stage_span.set_usage(response.usage)
+        return response
+
+
+async def acreate(client, stage, **kwargs):
+    kwargs = _routed(stage, kwargs)
+    if kwargs.get("stream"):
+        return await _acreate(client, stage, **kwargs)
+    with tracing.span(stage, model=kwargs["model"]) as stage_span:
+        response = await _acreate(client, stage, **kwargs)
+        stage_span.set_usage(response.usage)
+        return response
+
+
+def _create(client, stage, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        trial = _check_circuit(stage)
+        start = time.perf_counter()
+        try:
+            response = client.chat.completions.create(timeout=_timeout(stage), **kwargs)
+        except RETRYABLE_ERRORS as e:
+            _observe(stage, kwargs["model"], start, e)
+            _record_error(stage, e, attempt, trial)
+            time.sleep(_retry_delay(attempt))
+            continue
+        except APIError:
+            _count("errors")
+            breaker.record_failure()
+            raise
+        else:
+            _observe(stage, kwargs["model"], start)  # For streams, the time until the stream started
+            breaker.record_success()
+        finally:
+            if trial:
+                breaker.release_trial()  # No-op unless the call was cancelled or failed some other way
+        return _GuardedStream(response, stage) if kwargs.get("stream") else response
+
+
+async def _acreate(client, stage, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        trial = _check_circuit(stage)
+        start = time.perf_counter()
+        try:
+            response = await _on_shared_loop(client.chat.completions.create(timeout=_timeout(stage), **kwargs))
+        except RETRYABLE_ERRORS as e:
+            _observe(stage, kwargs["model"], start, e)
+            _record_error(stage, e, attempt, trial)
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        except APIError:
+            _count("errors")
+            breaker.record_failure()
+            raise
+        else:
+            _observe(stage, kwargs["model"], start)
+            breaker.record_success()
+        finally:
+            if trial:
+                breaker.release_trial()  # No-op unless the call was cancelled or failed some other way
+        return _SharedLoopStream(response, stage) if kwargs.get("stream") else response
+
+
+def metrics():
+    with _metrics_lock:
+        result = dict(_metrics)
+    responses = sum(v for k, v in result.items() if k.startswith("http_") and k.endswith("xx"))
+    result["connections_reused"] = max(0, responses - result.get("connections_opened", 0))
+    result["circuit_state"] = breaker.state
+    result["routing"] = router.stats()
+    return result
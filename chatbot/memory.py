@@ -0,0 +1,56 @@
+"""Bounded per-session conversation memory for prompts.
+
+The last MEMORY_WINDOW user/assistant messages are kept verbatim (compacted once, when added). Messages that fall out
+of the window are squeezed into a rolling summary of short "user asked ..." / "assistant said ..." lines, capped at
+SUMMARY_TOKEN_BUDGET by dropping its oldest lines, so a session's memory and the history we send stay the same size
+however long the conversation runs.
+"""
+import re
+from collections import deque
+
+from chatbot.context import compact, count_tokens
+
+MEMORY_WINDOW = 10
+SUMMARY_TOKEN_BUDGET = 150
+SUMMARY_LINE_WORDS = 25
+
+
+def _shorten(text, words=SUMMARY_LINE_WORDS):
+    first_sentence = re.split(r"(?<=[.!?])\s+", text, maxsplit=1)[0]
+    parts = first_sentence.split()
+    return " ".join(parts[:words]) + (" ..." if len(parts) > words else "")
+
+
+class ConversationMemory:
+    def __init__(self, window=MEMORY_WINDOW, summary_token_budget=SUMMARY_TOKEN_BUDGET):
+        self.summary_token_budget = summary_token_budget
+        self._turns = deque(maxlen=window)
+        self._summary = deque()  # (line, tokens)
+        self._summary_tokens = 0
+        self._messages = None
+
+    def add(self, role, content):
+        if len(self._turns) == self._turns.maxlen:
+            self._summarize(self._turns[0])
+        self._turns.append({"role": role, "content": compact(content)})
+        self._messages = None
+
+    def _summarize(self, message):
+        verb = "asked" if message["role"] == "user" else "said"
+        line = f"{message['role']} {verb}: {_shorten(message['content'])}"
+        tokens = count_tokens(line)
+        self._summary.append((line, tokens))
+        self._summary_tokens += tokens
+        while self._summary_tokens > self.summary_token_budget and len(self._summary) > 1:
+            self._summary_tokens -= self._summary.popleft()[1]
+
+    @property
+    def summary(self):
+        return "; ".join(line for line, _ in self._summary)
+
+    def messages(self):
+        """The summary (as a "summary" message, if there is one) followed by the recent messages, oldest first."""
+        if self._messages is None:
+            summary = [{"role": "summary", "content": self.summary}] if self._summary else []
+            self._messages = summary + list(self._turns)
+        return self._messages
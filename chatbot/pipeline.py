@@ -0,0 +1,210 @@
+"""Prompt building for the chat pipeline, and the concurrent asyncio version of it.
+
+The sync stage functions in main.py and the async ones here share the message builders and parsers below. In the
+concurrent pipeline the classification calls run at the same time as a speculative final answer for the raw prompt,
+with a guessed language and category. When the classifier agrees with the guesses and leaves the prompt as it is, the
+question costs roughly the slowest call instead of the sum of all of them; otherwise the speculative answer is thrown
+away and the final answer is asked for again with the real context.
+"""
+import asyncio
+import time
+
+from chatbot import tracing
+from chatbot.context import fit_context, compact_history
+from chatbot.llm import acreate
+from chatbot.structured import acreate_json
+from prompts import system_prompt, validity_prompt, category_prompt, classification_prompt, final_prompt_template
+
+# The speculative answer starts before the language and category are known: the language is guessed locally
+# (chatbot.fast_path), the category is the one most questions about a project guide get
+SPECULATIVE_LANGUAGE = "English"
+SPECULATIVE_CATEGORY = "Project Instructions"
+
+
+def _past_messages_message(past_messages):
+    history = compact_history(past_messages)
+    return {"role": "system", "content": "You have access to the following past messages for context:\n" + history
+            if history else ""}
+
+
+def validity_messages(prompt, context, past_messages):
+    return [
+        {"role": "system", "content": validity_prompt},
+        {"role": "system", "content": context},
+        _past_messages_message(past_messages),
+        {"role": "user", "content": prompt}
+    ]
+
+
+def classification_messages(prompt, context, past_messages):
+    return [
+        {"role": "system", "content": classification_prompt},
+        {"role": "system", "content": context},
+        _past_messages_message(past_messages),
+        {"role": "user", "content": prompt}
+    ]
+
+
+def category_messages(prompt, context):
+    return [
+        {"role": "system", "content": category_prompt},
+        {"role": "system", "content": context},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def final_context_prompt(grade, project_name, project_phase, language, question_category, project_driving_question,
+                         phase_overview, phase_instructions, supplemental_resources):
+    context, _ = fit_context("final", final_prompt_template, dict(
+        grade=grade,
+        project_name=project_name,
+        project_phase=project_phase,
+        category=question_category,
+        language=language,
+        project_driving_question=project_driving_question,
+        phase_overview=phase_overview,
+        phase_instructions=phase_instructions,
+        supplemental_resources=supplemental_resources
+    ))
+    return context
+
+
+def final_messages(context_prompt, prompt):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": context_prompt},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def validity_tuple(result):
+    return result["prompt"], result["is_valid"], result["language"], result["message"], result["is_default"]
+
+
+def classification_tuple(result):
+    return (*validity_tuple(result), result["category"])
+
+
+def _no_usage(stage, response, messages=None):
+    pass
+
+
+async def acheck_question_validity(client, prompt, context, past_messages, on_usage=_no_usage):
+    result = await acreate_json(client, "validity", validity_messages(prompt, context, past_messages), on_usage)
+    return validity_tuple(result)
+
+
+async def aclassify_question(client, prompt, context, past_messages, on_usage=_no_usage):
+    result = await acreate_json(client, "classification", classification_messages(prompt, context, past_messages),
+                                on_usage)
+    return classification_tuple(result)
+
+
+async def aget_question_category(client, prompt, context, on_usage=_no_usage):
+    result = await acreate_json(client, "category", category_messages(prompt, context), on_usage)
+    return result["category"]
+
+
+def _same(a, b):
+    return a.strip().strip('"').lower() == b.strip().strip('"').lower()
+
+
+class SpeculativeAnswer:
+    """A streamed final answer started in the background. Chunks are buffered until someone reads them with
+    `chunks()`, or thrown away with `cancel()`. Records "final_ttft" and "final_total" into `timings`.
+
+    `language` and `category` are what the context prompt was built with; `matches` tells whether the answer is the
+    one the classified question would get. With `speculative=False` it is just a final answer streamed from a task."""
+
+    def __init__(self, client, context_prompt, prompt, on_usage=_no_usage, language=None, category=None,
+                 speculative=True):
+        self.timings = {}
+        self.prompt = prompt
+        self.language = language
+        self.category = category
+        self.speculative = speculative
+        self._client = client
+        self._messages = final_messages(context_prompt, prompt)
+        self._on_usage = on_usage
+        self._buffer = []
+        self._changed = asyncio.Event()
+        self._done = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def _run(self):
+        start = time.perf_counter()
+        with tracing.span("final", streamed=True, speculative=self.speculative) as final_span:
+            try:
+                stream = await acreate(
+                    self._client, "final",
+                    messages=self._messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                async for chunk in stream:
+                    final_span.attributes.setdefault("model", chunk.model)  # As routed by llm.acreate
+                    if chunk.usage:
+                        self._on_usage("final", chunk, self._messages)
+                        final_span.set_usage(chunk.usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if "final_ttft" not in self.timings:
+                            self.timings["final_ttft"] = time.perf_counter() - start
+                        self._buffer.append(chunk.choices[0].delta.content)
+                        self._changed.set()
+            except asyncio.CancelledError:
+                final_span.set(cancelled=True)
+                raise
+            finally:
+                self.timings["final_total"] = time.perf_counter() - start
+                final_span.set(ttft=self.timings.get("final_ttft"))
+                self._done = True
+                self._changed.set()
+
+    async def chunks(self):
+        sent = 0
+        while True:
+            while sent < len(self._buffer):
+                sent += 1
+                yield self._buffer[sent - 1]
+            if self._done:
+                break
+            self._changed.clear()
+            await self._changed.wait()
+        self._task.result()  # Re-raise any error from the upstream call
+
+    def matches(self, prompt, language, category):
+        return (prompt.strip() == self.prompt.strip() and _same(language or "", self.language or "")
+                and _same(category or "", self.category or ""))
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+async def classify_with_speculation(client, prompt, context, past_messages, speculative_context_prompt,
+                                    speculative_language, speculative_category, combined, on_usage=_no_usage):
+    """Run classification (one combined call, or validity and category side by side) while a speculative final
+    answer for the raw prompt, built with the guessed language and category, streams in the background.
+
+    Returns ((rewritten_prompt, is_valid, language, message, is_default, category), speculative_answer). The caller
+    must either read the answer with `speculative_answer.chunks()` (only if `speculative_answer.matches` the
+    classification) or `cancel()` it."""
+    speculative_answer = SpeculativeAnswer(client, speculative_context_prompt, prompt, on_usage,
+                                           speculative_language, speculative_category).start()
+    try:
+        if combined:
+            classification = await aclassify_question(client, prompt, context, past_messages, on_usage)
+        else:
+            validity, category = await asyncio.gather(
+                acheck_question_validity(client, prompt, context, past_messages, on_usage),
+                aget_question_category(client, prompt, context, on_usage),
+            )
+            classification = (*validity, category)
+    except BaseException:
+        speculative_answer.cancel()
+        raise
+    return classification, speculative_answer
@@ -0,0 +1,137 @@
+"""Process-wide store of parsed project YAML files.
+
+Every project file is parsed once per process into read-only objects and re-read only when the file's mtime or size
+changes. With USE_COMPILED_CACHE, the parsed data is also pickled next to the YAML (<key>.yml.pickle) so a cold start
+skips the YAML parser; `python -m chatbot.project_store` precompiles every project.
+"""
+import os
+import pickle
+import threading
+
+import yaml
+
+PROJECT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "project_data")
+USE_COMPILED_CACHE = True
+COMPILED_CACHE_SUFFIX = ".pickle"
+
+# Grade -> project name -> project key, as offered in the app's dropdowns
+PROJECT_CATALOG = {
+    "Grade 5": {
+        "Heat Resistant House": {"key": "heat_resistant_house"},
+        "Community Park": {"key": "community_park"},
+    },
+    "Grade 6": {
+        "News Bulletin": {"key": "news_bulletin"},
+        "Healthy Snack Food": {"key": "healthy_snack_food"},
+    },
+    "Grade 7": {
+        "Healthy, Hyperlocal Restaurant": {"key": "healthy_hyperlocal_restaurant"},
+    },
+    "Grade 8": {
+        "Are We Cleaning Or Polluting?": {"key": "are_we_cleaning_or_polluting"},
+        "Carbon Footprint": {"key": "carbon_footprint"}
+    },
+}
+
+
+class FrozenDict(dict):
+    """A dict that can't be modified, so cached project data can be shared between sessions."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Project data is read-only")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+    """A list that can't be modified, so cached project data can be shared between sessions."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Project data is read-only")
+
+    __setitem__ = __delitem__ = append = extend = insert = pop = remove = clear = sort = reverse = __iadd__ = \
+        __imul__ = _readonly
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+
+def freeze(obj):
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(freeze(v) for v in obj)
+    return obj
+
+
+class ProjectStore:
+    def __init__(self, data_dir=PROJECT_DATA_DIR, use_compiled_cache=USE_COMPILED_CACHE):
+        self.data_dir = data_dir
+        self.use_compiled_cache = use_compiled_cache
+        self._entries = {}  # project_key -> (signature, data)
+        self._lock = threading.Lock()
+
+    def path(self, project_key):
+        return os.path.join(self.data_dir, f"{project_key}.yml")
+
+    def signature(self, project_key):
+        # Changes whenever the file is edited; anything derived from a project can be keyed on it
+        stat = os.stat(self.path(project_key))
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, project_key):
+        path = self.path(project_key)
+        signature = self.signature(project_key)
+        entry = self._entries.get(project_key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        with self._lock:
+            entry = self._entries.get(project_key)
+            if entry is None or entry[0] != signature:
+                entry = (signature, self._load(path, signature))
+                self._entries[project_key] = entry
+        return entry[1]
+
+    def project_keys(self):
+        return sorted(name[:-len(".yml")] for name in os.listdir(self.data_dir) if name.endswith(".yml"))
+
+    def _load(self, path, signature):
+        compiled_path = path + COMPILED_CACHE_SUFFIX
+        if self.use_compiled_cache:
+            try:
+                with open(compiled_path, "rb") as file:
+                    compiled_signature, data = pickle.load(file)
+                if compiled_signature == signature:
+                    return data
+            except (OSError, pickle.PickleError, EOFError, ValueError, TypeError):
+                pass
+
+        with open(path, "r", encoding="utf-8") as file:
+            data = freeze(yaml.safe_load(file))
+
+        if self.use_compiled_cache:
+            tmp_path = f"{compiled_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as file:
+                    pickle.dump((signature, data), file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, compiled_path)
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return data
+
+
+project_store = ProjectStore()
+
+
+def get_project(project_key):
+    return project_store.get(project_key)
+
+
+if __name__ == "__main__":
+    for key in project_store.project_keys():
+        project_store.get(key)
+        print(f"Compiled {project_store.path(key)}{COMPILED_CACHE_SUFFIX}")
@@ -0,0 +1,153 @@
+"""BM25 retrieval over the project YAML, so prompts carry only the parts of a phase relevant to the question.
+
+Each project is split into small chunks (phase overview, each activity's description, steps, commentary, and each
+list of guidelines/notes/materials) and indexed once per version of the file, i.e. whenever the project store hands
+back a freshly loaded object. `retrieve_context` picks the best chunks from the selected phase as
+`phase_instructions`, and the best chunks from the other phases as `supplemental_resources`, each within a token
+budget.
+"""
+import math
+import re
+import threading
+from collections import Counter
+
+from chatbot.answer_cache import tokenize, STOPWORDS
+from chatbot.context import compact, count_tokens, CHUNK_SEPARATOR, NO_SUPPLEMENTAL_RESOURCES
+from chatbot.project_store import get_project
+
+PHASE_TOKEN_BUDGET = 350
+SUPPLEMENTAL_TOKEN_BUDGET = 120
+CLASSIFIER_TOKEN_BUDGET = 150  # The classifier only has to tell whether the question is about the project
+TOP_K = 6
+SUPPLEMENTAL_MIN_SCORE = 2.0  # Other phases only contribute chunks that match the question well
+COMMENTARY_CHUNK_WORDS = 120
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+PHASE_SECTIONS = [
+    ("Tools & Materials", "tools_materials"),
+    ("Student Outputs", "student_output"),
+    ("Potential Questions", "potential_questions"),
+    ("Facilitation Notes", "facilitation_notes"),
+    ("General Guidelines", "general_guidelines"),
+]
+ACTIVITY_LISTS = [("Steps", "steps"), ("Simplifications", "simplifications"), ("Extensions", "extensions")]
+
+
+def _terms(text):
+    return [t for t in tokenize(text) if t not in STOPWORDS]
+
+
+def _split_words(text, size):
+    sentences = re.split(r"(?<=[.!?])\s+", " ".join(text.split()))
+    chunk = []
+    for sentence in sentences:
+        chunk.append(sentence)
+        if sum(len(s.split()) for s in chunk) >= size:
+            yield " ".join(chunk)
+            chunk = []
+    if chunk:
+        yield " ".join(chunk)
+
+
+def chunk_project(data):
+    """Split project data into [{"phase", "title", "text", "tokens"}] in document order."""
+    chunks = []
+
+    def add(phase, title, text):
+        if text and text.strip():
+            text = f"{title}:\n{text.strip()}"
+            chunks.append({"phase": phase, "title": title, "text": text, "tokens": count_tokens(text)})
+
+    for phase, details in data.get("phases", {}).items():
+        name = details.get("name", phase.title())
+        overview = [details.get("summary", "")]
+        if details.get("story_hook"):
+            overview.append("Story hook:\n" + compact(details["story_hook"]))
+        add(phase, f"{name} > Overview", "\n".join(overview))
+
+        for activity in details.get("activities", []):
+            title = f"{name} > {activity.get('name', 'Activity')}"
+            other = {k: v for k, v in activity.items()
+                     if k not in ("name", "commentary") and k not in {key for _, key in ACTIVITY_LISTS}}
+            add(phase, title, "\n".join(compact(v) if k == "description" else f"{k.title()}: {compact(v)}"
+                                        for k, v in other.items()))
+            for label, key in ACTIVITY_LISTS:
+                if activity.get(key):
+                    add(phase, f"{title} > {label}", compact(activity[key]))
+            for part in _split_words(activity.get("commentary", ""), COMMENTARY_CHUNK_WORDS):
+                add(phase, f"{title} > Teacher commentary", part)
+
+        for label, key in PHASE_SECTIONS:
+            if details.get(key):
+                add(phase, f"{name} > {label}", compact(details[key]))
+    return chunks
+
+
+class BM25Index:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self._documents = [Counter(_terms(chunk["text"])) for chunk in chunks]
+        self._lengths = [sum(document.values()) for document in self._documents]
+        self._average_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        document_frequency = Counter(t for document in self._documents for t in document)
+        n = len(self._documents)
+        self._idf = {t: math.log(1 + (n - df + 0.5) / (df + 0.5)) for t, df in document_frequency.items()}
+
+    def search(self, query, phases=None, exclude_phases=()):
+        """Return [(score, position)] for chunks matching `query`, best first."""
+        terms = set(_terms(query))
+        results = []
+        for position, (chunk, document) in enumerate(zip(self.chunks, self._documents)):
+            if (phases is not None and chunk["phase"] not in phases) or chunk["phase"] in exclude_phases:
+                continue
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[position] / (self._average_length or 1))
+            score = sum(self._idf[t] * document[t] * (BM25_K1 + 1) / (document[t] + length_norm)
+                        for t in terms if t in document)
+            if score > 0:
+                results.append((score, position))
+        results.sort(key=lambda x: -x[0])
+        return results
+
+    def select(self, results, token_budget, top_k=TOP_K):
+        """Take the best results that fit in `token_budget`, and return their texts in document order."""
+        chosen, used = [], 0
+        for _, position in results[:top_k]:
+            tokens = self.chunks[position]["tokens"]
+            if used + tokens <= token_budget:
+                chosen.append(position)
+                used += tokens
+        return CHUNK_SEPARATOR.join(self.chunks[position]["text"] for position in sorted(chosen))
+
+
+_indexes = {}  # project_key -> (project data the index was built from, BM25Index)
+_indexes_lock = threading.Lock()
+
+
+def get_index(project_key):
+    data = get_project(project_key)
+    entry = _indexes.get(project_key)
+    if entry is not None and entry[0] is data:
+        return entry[1]
+    with _indexes_lock:
+        entry = _indexes.get(project_key)
+        if entry is None or entry[0] is not data:
+            entry = (data, BM25Index(chunk_project(data)))
+            _indexes[project_key] = entry
+    return entry[1]
+
+
+def retrieve_context(project_key, project_phase, query, phase_token_budget=PHASE_TOKEN_BUDGET,
+                     supplemental_token_budget=SUPPLEMENTAL_TOKEN_BUDGET):
+    """Return (phase_instructions, supplemental_resources) for `query` on this project and phase."""
+    index = get_index(project_key)
+    phase = project_phase.lower()
+    results = index.search(query, phases={phase})
+    if not results:
+        # Nothing matches (e.g. "what do we do next?"), so fall back to the start of the phase
+        results = [(0.0, position) for position, chunk in enumerate(index.chunks) if chunk["phase"] == phase]
+    phase_instructions = index.select(results, phase_token_budget)
+
+    supplemental = [x for x in index.search(query, exclude_phases={phase}) if x[0] >= SUPPLEMENTAL_MIN_SCORE]
+    supplemental_resources = index.select(supplemental, supplemental_token_budget) or NO_SUPPLEMENTAL_RESOURCES
+    return phase_instructions, supplemental_resources
@@ -0,0 +1,109 @@
+"""Per-stage model routing with latency-aware fallback.
+
+Each stage has its own model and request parameters (STAGE_MODELS, STAGE_PARAMS), so the classification stages, which
+only emit a few dozen tokens of JSON, are capped at that instead of paying for the answer stage's settings. The router
+keeps every model's latencies per stage for the last LATENCY_WINDOW_SECONDS. While a stage's model has a p95 above the
+stage's budget (STAGE_P95_BUDGETS) over at least MIN_SAMPLES calls, the stage fails over to its FALLBACK_MODELS entry;
+once the slow samples have aged out of the window, the stage goes back to its own model.
+"""
+import math
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+STAGE_MODELS = {
+    "validity": "gpt-3.5-turbo",
+    "classification": "gpt-3.5-turbo",
+    "category": "gpt-3.5-turbo",
+    "final": "gpt-3.5-turbo",
+    "translation": "gpt-3.5-turbo",
+}
+FALLBACK_MODELS = {
+    "validity": "gpt-4o-mini",
+    "classification": "gpt-4o-mini",
+    "category": "gpt-4o-mini",
+    "final": "gpt-4o-mini",
+}
+# max_tokens leaves room for the rewritten prompt and message in the JSON stages, and for a 60 word answer in Hindi
+STAGE_PARAMS = {
+    "validity": {"temperature": 0, "max_tokens": 300},
+    "classification": {"temperature": 0, "max_tokens": 300},
+    "category": {"temperature": 0, "max_tokens": 20},
+    "final": {"temperature": 0.1, "max_tokens": 400},
+    "translation": {"temperature": 0, "max_tokens": 200},
+}
+# Seconds. For streamed calls the latency is the time until the stream starts
+STAGE_P95_BUDGETS = {"validity": 2.5, "classification": 3.0, "category": 2.0, "final": 4.0}
+LATENCY_WINDOW_SECONDS = 300
+MIN_SAMPLES = 20
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class ModelRouter:
+    def __init__(self, stage_models=None, fallback_models=None, stage_params=None, p95_budgets=None,
+                 window_seconds=LATENCY_WINDOW_SECONDS, min_samples=MIN_SAMPLES):
+        self.stage_models = {**STAGE_MODELS, **(stage_models or {})}
+        self.fallback_models = {**FALLBACK_MODELS, **(fallback_models or {})}
+        self.stage_params = {**STAGE_PARAMS, **(stage_params or {})}
+        self.p95_budgets = {**STAGE_P95_BUDGETS, **(p95_budgets or {})}
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self._latencies = defaultdict(deque)  # (stage, model) -> deque of (monotonic time, seconds)
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def _window(self, stage, model, now):
+        samples = self._latencies[(stage, model)]
+        while samples and samples[0][0] < now - self.window_seconds:
+            samples.popleft()
+        return samples
+
+    def observe(self, stage, model, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._window(stage, model, now).append((now, seconds))
+
+    def p95(self, stage, model):
+        """The model's p95 latency for this stage over the window, or None with fewer than MIN_SAMPLES calls."""
+        with self._lock:
+            samples = self._window(stage, model, time.monotonic())
+            if len(samples) < self.min_samples:
+                return None
+            return percentile([seconds for _, seconds in samples], 95)
+
+    def model(self, stage):
+        model = self.stage_models[stage]
+        fallback = self.fallback_models.get(stage)
+        budget = self.p95_budgets.get(stage)
+        if fallback and budget is not None:
+            p95 = self.p95(stage, model)
+            if p95 is not None and p95 > budget:
+                self._count(f"{stage}_failovers")
+                return fallback
+        return model
+
+    def request(self, stage):
+        """Keyword arguments for this stage's chat completion: the routed model and the stage's parameters."""
+        return {"model": self.model(stage), **self.stage_params.get(stage, {})}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            result = dict(self._stats)
+            for (stage, model), samples in self._latencies.items():
+                latencies = [seconds for _, seconds in self._window(stage, model, now)]
+                if latencies:
+                    result[f"{stage}/{model}"] = {"calls": len(latencies), "p50": percentile(latencies, 50),
+                                                  "p95": percentile(latencies, 95)}
+        return result
+
+
+router = ModelRouter()
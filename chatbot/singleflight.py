@@ -0,0 +1,138 @@
+"""Process-wide single-flight for identical questions asked at the same time.
+
+The first session to ask a question leads its flight and answers it as usual; sessions asking the same question (same
+key) while it is in flight follow it instead of calling the API themselves. The leader publishes what it shows as it
+goes (warnings and streamed answer chunks, then the final message), so followers render the same answer at the same
+pace. If the leader's run ends without an answer (an error, or the user navigating away) the flight is abandoned and
+its followers ask again, one of them becoming the new leader. A follower gives up waiting after FOLLOWER_TIMEOUT
+seconds and answers on its own.
+
+The leader's publishing goes through a context variable, so `publish` and `finish` can be called from anywhere in its
+run, including asyncio tasks, and do nothing in runs that don't lead a flight.
+"""
+import contextvars
+import threading
+import time
+from collections import Counter
+
+FOLLOWER_TIMEOUT = 60  # Seconds; longer than the classification and final stage timeouts together
+
+_current_flight = contextvars.ContextVar("current_flight", default=None)
+
+
+class FlightAbandoned(Exception):
+    pass
+
+
+class FlightTimeout(Exception):
+    pass
+
+
+class Flight:
+    def __init__(self, key):
+        self.key = key
+        self.events = []  # ("warning" | "chunk", text), in the order the leader showed them
+        self.message = None
+        self.abandoned = False
+        self.followers = 0
+        self._condition = threading.Condition()
+        self._token = None
+
+    @property
+    def done(self):
+        return self.message is not None or self.abandoned
+
+    def publish(self, kind, text):
+        with self._condition:
+            if not self.done:
+                self.events.append((kind, text))
+                self._condition.notify_all()
+
+    def finish(self, message):
+        with self._condition:
+            if not self.done:
+                self.message = message
+                self._condition.notify_all()
+
+    def abandon(self):
+        with self._condition:
+            if not self.done:
+                self.abandoned = True
+                self._condition.notify_all()
+
+    def follow(self, timeout=FOLLOWER_TIMEOUT):
+        """Yield the leader's events as they are published, then ("message", final message).
+        Raises FlightAbandoned if the leader gave up, FlightTimeout if it takes longer than `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        seen = 0
+        while True:
+            with self._condition:
+                while seen == len(self.events) and not self.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise FlightTimeout(f"No answer after {timeout}s")
+                    self._condition.wait(remaining)
+                new_events = self.events[seen:]
+                message, abandoned = self.message, self.abandoned
+            seen += len(new_events)
+            yield from new_events
+            if abandoned:
+                raise FlightAbandoned("The leading session stopped before answering")
+            if message is not None and seen == len(self.events):
+                yield "message", message
+                return
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}  # key -> Flight in progress
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def join(self, key):
+        """Return (flight, leading). The caller must `release` a flight it leads once its run is over."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.done:
+                flight.followers += 1
+                self._stats["coalesced"] += 1
+                return flight, False
+            flight = Flight(key)
+            self._flights[key] = flight
+            self._stats["leaders"] += 1
+        flight._token = _current_flight.set(flight)
+        return flight, True
+
+    def release(self, flight):
+        if flight._token is not None:
+            _current_flight.reset(flight._token)
+            flight._token = None
+        if not flight.done:
+            flight.abandon()
+            self.count("abandoned")
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._flights)}
+
+
+single_flight = SingleFlight()
+
+
+def publish(kind, text):
+    flight = _current_flight.get()
+    if flight is not None:
+        flight.publish(kind, text)
+
+
+def finish(message):
+    flight = _current_flight.get()
+    if flight is not None:
+        flight.finish(message)
@@ -0,0 +1,169 @@
+"""Structured JSON outputs for the classification stages.
+
+`create_json` / `acreate_json` ask for the stage's JSON schema as a response format: a strict "json_schema" on models
+that support it (JSON_SCHEMA_MODELS), plain "json_object" mode otherwise. Whatever comes back goes through `loads`,
+which repairs the usual malformations (code fences, prose around the object, trailing commas, single quotes,
+Python-style True/False/None) and checks the stage's fields. Only if that fails is the same stage asked again, at most
+MAX_REASKS times, with its bad answer and a reminder of the format; then the call fails with MalformedOutput, which
+main.py treats like an unavailable upstream. Clean, repaired and failed parses and re-asks are counted in `stats()`.
+"""
+import ast
+import json
+import re
+import threading
+from collections import Counter
+
+from chatbot import llm
+from chatbot.router import router
+
+MAX_REASKS = 1
+JSON_SCHEMA_MODELS = ("gpt-4o-mini", "gpt-4o-2024-08-06", "gpt-4o-2024-11-20", "gpt-4.1", "gpt-5")  # Name prefixes
+REASK_MESSAGE = "That was not a valid JSON object in the requested format. Respond with the JSON object only."
+
+CATEGORIES = [
+    "Greeting", "Project Overview", "Project Instructions", "Project Resources", "Project Preparation",
+    "Conceptual Questions", "Logistical Challenges", "Project Customization", "Suggestions for Alternate Activities",
+    "Project Feedback", "Unrelated", "Unknown", "Other",
+]
+VALIDITY_FIELDS = {"prompt": str, "is_valid": bool, "language": str, "message": str, "is_default": bool}
+STAGE_FIELDS = {
+    "validity": VALIDITY_FIELDS,
+    "classification": {**VALIDITY_FIELDS, "category": str},
+    "category": {"category": str},
+}
+
+
+class MalformedOutput(llm.UpstreamUnavailable):
+    """The model's answer couldn't be read as the stage's JSON, even after repairs and re-asking."""
+    pass
+
+
+def _schema(stage):
+    properties = {name: {"type": "boolean" if kind is bool else "string"} for name, kind in STAGE_FIELDS[stage].items()}
+    if "category" in properties:
+        properties["category"] = {"type": "string", "enum": CATEGORIES}
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+def response_format(stage, model):
+    if model.startswith(JSON_SCHEMA_MODELS):
+        return {"type": "json_schema", "json_schema": {"name": stage, "strict": True, "schema": _schema(stage)}}
+    return {"type": "json_object"}
+
+
+_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+# String literals (left alone) or bare words that are literals in only one of JSON and Python
+_LITERAL_PATTERN = re.compile(r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')|\b(true|false|null|True|False|None)\b")
+_TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+_TO_JSON = {"True": "true", "False": "false", "None": "null"}
+_TO_PYTHON = {"true": "True", "false": "False", "null": "None"}
+
+
+def _replace_literals(text, mapping):
+    return _LITERAL_PATTERN.sub(lambda m: m.group(1) or mapping.get(m.group(2), m.group(2)), text)
+
+
+def _extract_object(text):
+    fenced = _FENCE_PATTERN.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start, end = text.find("{"), text.rfind("}")
+    return text[start:end + 1] if start != -1 and end > start else text.strip()
+
+
+def _repair(text):
+    candidate = _extract_object(text)
+    attempts = [
+        lambda: json.loads(candidate),
+        lambda: json.loads(_TRAILING_COMMA_PATTERN.sub(r"\1", _replace_literals(candidate, _TO_JSON))),
+        lambda: ast.literal_eval(_replace_literals(candidate, _TO_PYTHON)),  # Single quotes
+    ]
+    for attempt in attempts:
+        try:
+            result = attempt()
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        if isinstance(result, dict):
+            return result
+    return None
+
+
+def _check_fields(stage, result):
+    checked = {}
+    for name, kind in STAGE_FIELDS[stage].items():
+        value = result.get(name)
+        if kind is bool and isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            value = value.strip().lower() == "true"
+        elif kind is str and value is None and name == "message":
+            value = ""
+        if not isinstance(value, kind):
+            return None
+        checked[name] = value
+    return checked
+
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def loads(stage, content):
+    """The stage's fields from the model's answer, repaired if need be. Raises MalformedOutput."""
+    try:
+        result = json.loads(content)
+        repaired = False
+    except (TypeError, ValueError):
+        result, repaired = _repair(content or ""), True
+    checked = _check_fields(stage, result) if isinstance(result, dict) else None
+    if checked is None:
+        _count(f"{stage}_failed")
+        raise MalformedOutput(f"The {stage} answer is not the expected JSON: {content!r:.200}")
+    _count(f"{stage}_repaired" if repaired else f"{stage}_ok")
+    return checked
+
+
+def _request(stage, messages):
+    request = router.request(stage)
+    return dict(request, messages=messages, response_format=response_format(stage, request["model"]))
+
+
+def _reask_messages(messages, content):
+    return messages + [{"role": "assistant", "content": content or ""}, {"role": "user", "content": REASK_MESSAGE}]
+
+
+def create_json(client, stage, messages, on_usage):
+    """Call the stage and return its parsed fields, re-asking the same stage at most MAX_REASKS times."""
+    for attempt in range(MAX_REASKS + 1):
+        response = llm.create(client, stage, **_request(stage, messages))
+        on_usage(stage, response, messages)
+        content = response.choices[0].message.content
+        try:
+            return loads(stage, content)
+        except MalformedOutput:
+            if attempt == MAX_REASKS:
+                raise
+            _count(f"{stage}_reasks")
+            messages = _reask_messages(messages, content)
+
+
+async def acreate_json(client, stage, messages, on_usage):
+    for attempt in range(MAX_REASKS + 1):
+        response = await llm.acreate(client, stage, **_request(stage, messages))
+        on_usage(stage, response, messages)
+        content = response.choices[0].message.content
+        try:
+            return loads(stage, content)
+        except MalformedOutput:
+            if attempt == MAX_REASKS:
+                raise
+            _count(f"{stage}_reasks")
+            messages = _reask_messages(messages, content)
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,186 @@
+"""Tracing spans for the chat pipeline.
+
+`span(name, **attributes)` times a block; spans opened inside it (including in asyncio tasks started inside it) become
+its children, and the outermost span is the trace. Finished traces are exported, depending on TRACE_EXPORTER:
+  "otlp_json"   one OTLP/JSON ExportTraceServiceRequest per line in gzip files under logs/traces/ (the default),
+                written by a background chatbot.transcript_log.LogSink with the same queue limits and rotation
+  "prometheus"  span duration histograms and token counters on http://localhost:PROMETHEUS_PORT/metrics
+                (needs prometheus_client)
+  "none"        nothing
+"""
+import contextlib
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+
+from chatbot.transcript_log import LogSink
+
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "otlp_json")
+TRACE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs", "traces")
+PROMETHEUS_PORT = int(os.environ.get("PROMETHEUS_PORT", 9464))
+SERVICE_NAME = "pbl-chatbot"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.trace = parent.trace if parent else []  # Finished spans of the whole trace, shared by all its spans
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def set_usage(self, usage):
+        if usage is not None:
+            self.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+    @property
+    def duration(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+
+def current_span():
+    return _current_span.get()
+
+
+def root_span():
+    span = _current_span.get()
+    while span is not None and span.parent is not None:
+        span = span.parent
+    return span
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    parent = _current_span.get()
+    new_span = Span(name, parent, attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except Exception as e:  # st.stop() and st.rerun() are BaseExceptions, and not errors
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end_ns = time.time_ns()
+        new_span.trace.append(new_span)
+        if parent is None:
+            export(new_span.trace)
+
+
+def add_span(name, start_ns, **attributes):
+    """Record a finished child of the current span, for work that can't sit inside a `with span()` block (such as
+    a generator streaming an answer)."""
+    parent = _current_span.get()
+    if parent is None:
+        return
+    finished = Span(name, parent, attributes)
+    finished.start_ns = start_ns
+    finished.end_ns = time.time_ns()
+    parent.trace.append(finished)
+
+
+def set_outcome(outcome):
+    root = root_span()
+    if root is not None:
+        root.set(outcome=outcome)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span):
+    result = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items() if v is not None],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        result["parentSpanId"] = span.parent_id
+    return result
+
+
+class OtlpJsonExporter:
+    def __init__(self, log_dir=TRACE_DIR):
+        self.sink = LogSink(log_dir=log_dir, file_prefix="traces")
+
+    def export(self, spans):
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "chatbot"}, "spans": [_otlp_span(s) for s in spans]}],
+        }]}
+        self.sink.put("trace", json.dumps(request, separators=(",", ":")) + "\n")
+
+
+class PrometheusExporter:
+    def __init__(self, port=PROMETHEUS_PORT):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise RuntimeError("TRACE_EXPORTER=prometheus needs prometheus_client: pip install prometheus-client")
+        self._durations = prometheus_client.Histogram(
+            "chatbot_span_seconds", "Duration of chat pipeline spans", ["span", "outcome"],
+            buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+        self._tokens = prometheus_client.Counter(
+            "chatbot_tokens", "Tokens used by chat pipeline calls", ["span", "kind"])
+        self._errors = prometheus_client.Counter("chatbot_span_errors", "Chat pipeline spans that raised", ["span"])
+        prometheus_client.start_http_server(port)
+
+    def export(self, spans):
+        outcome = spans[-1].attributes.get("outcome", "")  # The root span finishes last
+        for s in spans:
+            self._durations.labels(s.name, outcome).observe(s.duration)
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if s.attributes.get(kind):
+                    self._tokens.labels(s.name, kind).inc(s.attributes[kind])
+            if s.error:
+                self._errors.labels(s.name).inc()
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    # Created on first use, once per process, so Streamlit reruns don't start a second metrics server
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                if TRACE_EXPORTER == "otlp_json":
+                    _exporter = OtlpJsonExporter()
+                elif TRACE_EXPORTER == "prometheus":
+                    _exporter = PrometheusExporter()
+                else:
+                    _exporter = False
+    return _exporter
+
+
+def export(spans):
+    exporter = get_exporter()
+    if exporter:
+        exporter.export(spans)
@@ -0,0 +1,134 @@
+"""Non-blocking transcript and debug log.
+
+`log_sink.log(kind, **fields)` only puts a record on a bounded in-memory queue; a background thread writes the records
+as JSON lines to gzip files under logs/transcripts/, starting a new file every ROTATE_BYTES of uncompressed output
+(and at midnight). Nothing on the request path ever waits for the disk:
+- kinds can be sampled (SAMPLE_RATES), e.g. keep every transcript record but only some debug blobs,
+- once the queue holds more than SOFT_LIMIT_BYTES, only "transcript" records are accepted, and past
+  MAX_QUEUE_BYTES everything is dropped until the writer catches up. Dropped records are counted in `stats()`.
+Other logs can have a sink of their own with another directory and file prefix, e.g. the traces of chatbot.tracing,
+and queue lines they format themselves with `put`.
+"""
+import atexit
+import datetime
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import Counter
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs", "transcripts")
+MAX_QUEUE_BYTES = 8 * 1024 * 1024
+SOFT_LIMIT_BYTES = MAX_QUEUE_BYTES // 2
+ROTATE_BYTES = 64 * 1024 * 1024
+FLUSH_INTERVAL = 2.0  # Seconds between flushes of the open file while records keep arriving
+SAMPLE_RATES = {"transcript": 1.0, "request": 1.0, "debug": 0.2}
+PRIORITY_KINDS = {"transcript"}
+
+_STOP = object()
+
+
+class LogSink:
+    def __init__(self, log_dir=LOG_DIR, max_queue_bytes=MAX_QUEUE_BYTES, soft_limit_bytes=SOFT_LIMIT_BYTES,
+                 rotate_bytes=ROTATE_BYTES, sample_rates=None, file_prefix="transcripts"):
+        self.log_dir = log_dir
+        self.file_prefix = file_prefix
+        self.max_queue_bytes = max_queue_bytes
+        self.soft_limit_bytes = soft_limit_bytes
+        self.rotate_bytes = rotate_bytes
+        self.sample_rates = {**SAMPLE_RATES, **(sample_rates or {})}
+        self._queue = queue.SimpleQueue()
+        self._queued_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._thread = None
+        self._file = None
+        self._file_day = None
+        self._file_bytes = 0
+
+    def log(self, kind, **fields):
+        """Queue one record. Never blocks; returns False if the record was sampled out or dropped."""
+        if random.random() >= self.sample_rates.get(kind, 1.0):
+            self._count("sampled_out")
+            return False
+        line = json.dumps({"ts": time.time(), "kind": kind, **fields}, ensure_ascii=False, default=str) + "\n"
+        return self.put(kind, line)
+
+    def put(self, kind, line):
+        """Queue one already formatted line, subject to the same limits as `log` but not sampled."""
+        size = len(line)
+        with self._lock:
+            limit = self.max_queue_bytes if kind in PRIORITY_KINDS else self.soft_limit_bytes
+            if self._queued_bytes + size > limit:
+                self._stats["dropped"] += 1
+                return False
+            self._queued_bytes += size
+            self._stats["queued"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"{self.file_prefix}-log", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        self._queue.put(line)
+        return True
+
+    def _count(self, key):
+        # Called from the session threads and the writer thread alike
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "queued_bytes": self._queued_bytes}
+
+    def close(self, timeout=5):
+        # Drain what is queued and finish the gzip file, e.g. at interpreter exit
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                line = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                line = None
+            if line is _STOP:
+                break
+            if line is not None:
+                self._write(line)
+            if self._file is not None and (line is None or time.monotonic() - last_flush >= FLUSH_INTERVAL):
+                self._file.flush()
+                last_flush = time.monotonic()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line):
+        with self._lock:
+            self._queued_bytes -= len(line)
+        try:
+            data = line.encode("utf-8")
+            today = datetime.date.today()
+            if self._file is None or self._file_bytes + len(data) > self.rotate_bytes or self._file_day != today:
+                self._open(today)
+            self._file.write(data)
+            self._file_bytes += len(data)
+            self._count("written")
+        except OSError:
+            self._count("write_errors")
+
+    def _open(self, today):
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.log_dir, exist_ok=True)
+        name = f"{self.file_prefix}-{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz"
+        self._file = gzip.open(os.path.join(self.log_dir, name), "ab")
+        self._file_day = today
+        self._file_bytes = 0
+
+
+log_sink = LogSink()
@@ -0,0 +1,123 @@
+"""Load test: replay question transcripts through the real main.py with N concurrent sessions.
+
+Each session is a Streamlit AppTest of main.py, talking to the stub server (started in-process unless --base-url
+points elsewhere). Reports end-to-end latency percentiles per question and reruns per second:
+
+    python -m loadtest.run --sessions 8 --rounds 2 --latency final=1.5:0.4 --error-rate 0.02
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import yaml
+
+from loadtest import stub_server
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+TRANSCRIPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts.yml")
+APP_TIMEOUT = 120
+
+
+def run_session(session, transcript, rounds, results, lock):
+    # Every session leaves a record, so one that dies (e.g. racing the others on Streamlit's global Runtime) shows up
+    # in the report instead of silently shrinking the session count
+    record = {"session": session, "load": None, "latencies": [], "errors": 0, "reruns": 0, "failed": None}
+    try:
+        # Imported here so the stub and environment are set up before Streamlit loads
+        from streamlit.testing.v1 import AppTest
+
+        app = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT)
+        app.secrets["OPENAI_API_KEY"] = "stub"
+        start = time.perf_counter()
+        app.run()
+        record["load"] = time.perf_counter() - start
+        record["reruns"] += 1
+        for _ in range(rounds):
+            for question in transcript:
+                start = time.perf_counter()
+                app.chat_input(key="chat_input").set_value(question).run()
+                record["latencies"].append(time.perf_counter() - start)
+                record["reruns"] += 1
+                if app.exception:
+                    record["errors"] += 1
+    except Exception as e:
+        record["failed"] = f"{type(e).__name__}: {e}"
+        record["errors"] += 1
+    finally:
+        with lock:
+            results.append(record)
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+def report(results, elapsed):
+    latencies = sorted(x for record in results for x in record["latencies"])
+    reruns = sum(record["reruns"] for record in results)
+    failed = [record for record in results if record["failed"]]
+    loads = [record["load"] for record in results if record["load"] is not None]
+    lines = [
+        f"sessions: {len(results)}",
+        f"failed sessions: {len(failed)}",
+        f"questions: {len(latencies)}",
+        f"errors: {sum(record['errors'] for record in results)}",
+        f"wall time: {elapsed:.2f}s",
+        f"reruns/s: {reruns / elapsed:.2f}",
+        f"questions/s: {len(latencies) / elapsed:.2f}",
+    ]
+    if loads:
+        lines.append(f"page load mean: {statistics.mean(loads):.3f}s")
+    if latencies:
+        lines += [f"latency p{q}: {percentile(latencies, q):.3f}s" for q in (50, 95, 99)]
+        lines.append(f"latency max: {latencies[-1]:.3f}s")
+    lines += [f"session {record['session']} failed after {len(record['latencies'])} questions: {record['failed']}"
+              for record in sorted(failed, key=lambda record: record["session"])]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay chat transcripts through main.py against the stub API.")
+    parser.add_argument("--sessions", type=int, default=4, help="Concurrent sessions")
+    parser.add_argument("--rounds", type=int, default=1, help="Times each session replays its transcript")
+    parser.add_argument("--transcripts", default=TRANSCRIPTS_PATH, help="YAML list of question lists")
+    parser.add_argument("--base-url", default=None, help="Use an already running API instead of the in-process stub")
+    parser.add_argument("--keep-answer-cache", action="store_true",
+                        help="Use the normal answer cache instead of a fresh temporary one")
+    stub_server.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with open(args.transcripts, "r", encoding="utf-8") as file:
+        transcripts = yaml.safe_load(file)
+
+    server = None
+    if args.base_url is None:
+        server = stub_server.start_in_thread(port=0, latency=stub_server.parse_latency(args.latency),
+                                             error_rate=args.error_rate, token_delay=args.token_delay,
+                                             malformed_rate=args.malformed_rate)
+        args.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ["OPENAI_BASE_URL"] = args.base_url
+    if not args.keep_answer_cache:
+        # Stub answers must not end up in the real answer cache
+        os.environ["ANSWER_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "answer_cache.sqlite3")
+
+    results, lock = [], threading.Lock()
+    threads = [threading.Thread(target=run_session,
+                                args=(i, transcripts[i % len(transcripts)], args.rounds, results, lock))
+               for i in range(args.sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+    print(report(results, elapsed))
+
+
+if __name__ == "__main__":
+    main()
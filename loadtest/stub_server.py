@@ -0,0 +1,201 @@
+"""OpenAI-compatible stub of /v1/chat/completions for running the chatbot without the live API.
+
+Recognises the pipeline's stages by their system prompts and answers each one in its schema: validity,
+classification and category calls get JSON, translation calls the question back, final calls a canned answer
+(streamed if asked). Latency is drawn from a lognormal distribution per stage, a fraction of calls can be made to
+fail, and a fraction of the JSON answers can be malformed the way models sometimes malform them:
+
+    python -m loadtest.stub_server --port 8765 --latency validity=0.6:0.4 --latency final=1.5 --error-rate 0.02 \
+        --malformed-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 streamlit run main.py
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompts import validity_prompt, category_prompt, classification_prompt, translation_prompt
+
+DEFAULT_LATENCY = {"validity": (0.5, 0.3), "classification": (0.6, 0.3), "category": (0.4, 0.3), "final": (1.2, 0.4),
+                   "translation": (0.4, 0.3)}
+DEFAULT_TOKEN_DELAY = 0.02  # Seconds between streamed chunks
+GREETINGS = {"hi", "hello", "hey", "thanks", "thank you", "namaste"}
+UNRELATED_WORDS = {"cricket", "movie", "weather", "bitcoin", "election"}
+CANNED_ANSWER = ("- Start with the activity in the project guide for this phase.\n"
+                 "- Keep materials simple and let students observe first.\n"
+                 "- Ask them to note what they see and share it with the group.")
+
+
+def detect_stage(messages):
+    system = [m["content"] for m in messages if m["role"] == "system"]
+    if classification_prompt in system:
+        return "classification"
+    if validity_prompt in system:
+        return "validity"
+    if category_prompt in system:
+        return "category"
+    if any(s.startswith(translation_prompt.split("{")[0]) for s in system):
+        return "translation"
+    return "final"
+
+
+def stage_content(stage, question):
+    words = set(re.findall(r"\w+", question.lower()))
+    is_default = question.strip(" !.?").lower() in GREETINGS
+    category = "Greeting" if is_default else "Unrelated" if words & UNRELATED_WORDS else "Project Instructions"
+    validity = {"prompt": question, "is_valid": True, "language": "English",
+                "message": "Hello! How can I help with your project?" if is_default else "", "is_default": is_default}
+    if stage == "validity":
+        return json.dumps(validity)
+    if stage == "classification":
+        return json.dumps({**validity, "category": category})
+    if stage == "category":
+        return json.dumps({"category": category})
+    if stage == "translation":
+        return question  # The stub doesn't translate
+    return CANNED_ANSWER
+
+
+def malform(content):
+    return random.choice([
+        lambda: f"```json\n{content}\n```",
+        lambda: f"Here is the JSON you asked for: {content[:-1]},}}",
+        lambda: content.replace('"', "'").replace("true", "True").replace("false", "False"),
+        lambda: "I'm sorry, I can't help with that.",  # Not repairable; makes the client ask again
+    ])()
+
+
+def _usage(messages, content):
+    prompt_tokens = sum(math.ceil(len(m["content"]) / 4) + 4 for m in messages) + 3
+    completion_tokens = math.ceil(len(content) / 4)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so client connection pooling behaves like it does against the API
+    config = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        config = self.config
+        messages = body["messages"]
+        stage = detect_stage(messages)
+        median, sigma = config["latency"][stage]
+        time.sleep(random.lognormvariate(math.log(median), sigma) if median > 0 else 0)
+
+        if random.random() < config["error_rate"]:
+            status = random.choice([429, 500, 503])
+            self._send_json(status, {"error": {"message": "Stub error", "type": "server_error", "code": status}})
+            return
+
+        content = stage_content(stage, messages[-1]["content"])
+        if stage in ("validity", "classification", "category") and random.random() < config["malformed_rate"]:
+            content = malform(content)
+        created = int(time.time())
+        if not body.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": created, "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": _usage(messages, content),
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created,
+                 "model": body.get("model")}
+        try:
+            for i, token in enumerate(re.findall(r"\s*\S+", content)):
+                if i:
+                    time.sleep(config["token_delay"])
+                delta = {**chunk, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                self._write_chunk(f"data: {json.dumps(delta)}\n\n".encode())
+            if body.get("stream_options", {}).get("include_usage"):
+                usage_chunk = {**chunk, "choices": [], "usage": _usage(messages, content)}
+                self._write_chunk(f"data: {json.dumps(usage_chunk)}\n\n".encode())
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, e.g. a speculative answer that was cancelled
+            self.close_connection = True
+
+
+def make_server(host="127.0.0.1", port=8765, latency=None, error_rate=0.0, token_delay=DEFAULT_TOKEN_DELAY,
+                malformed_rate=0.0):
+    """A ThreadingHTTPServer for the stub. `latency` maps stages to (median seconds, lognormal sigma)."""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"config": {
+        "latency": {**DEFAULT_LATENCY, **(latency or {})}, "error_rate": error_rate, "token_delay": token_delay,
+        "malformed_rate": malformed_rate}})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_thread(**kwargs):
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_latency(values):
+    """["final=1.5:0.4", "validity=0.3"] -> {"final": (1.5, 0.4), "validity": (0.3, 0.3)}"""
+    latency = {}
+    for value in values or []:
+        stage, _, spec = value.partition("=")
+        median, _, sigma = spec.partition(":")
+        if stage not in DEFAULT_LATENCY:
+            raise argparse.ArgumentTypeError(f"Unknown stage {stage!r}, expected one of {list(DEFAULT_LATENCY)}")
+        latency[stage] = (float(median), float(sigma) if sigma else DEFAULT_LATENCY[stage][1])
+    return latency
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", action="append", metavar="STAGE=MEDIAN[:SIGMA]",
+                        help="Lognormal latency per stage in seconds, e.g. final=1.5:0.4 (repeatable)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with 429/5xx")
+    parser.add_argument("--token-delay", type=float, default=DEFAULT_TOKEN_DELAY,
+                        help="Seconds between streamed chunks")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Fraction of JSON answers wrapped in fences, prose, trailing commas or single quotes")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for the chatbot.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    server = make_server(args.host, args.port, parse_latency(args.latency), args.error_rate, args.token_delay,
+                         args.malformed_rate)
+    print(f"Stub OpenAI API on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
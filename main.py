@@ -1,88 +1,144 @@
+import asyncio
 import base64
+import functools
+import hashlib
 import json
+import math
+import time
+import uuid
 
 import streamlit as st
-import yaml
-from openai import OpenAI
 from streamlit.components.v1 import html
 from streamlit_float import float_css_helper, float_parent, float_init
 
-from prompts import system_prompt, validity_prompt, category_prompt, context_template, final_prompt_template
+from chatbot.pipeline import (validity_messages, classification_messages, category_messages, final_context_prompt,
+                              final_messages, validity_tuple, classification_tuple, classify_with_speculation,
+                              SpeculativeAnswer, SPECULATIVE_LANGUAGE, SPECULATIVE_CATEGORY)
+from chatbot import fast_path, llm, singleflight, structured, tracing
+from chatbot.admission import admission, Shed
+from chatbot.answer_bank import answer_bank
+from chatbot.answer_cache import answer_cache, normalize_question
+from chatbot.context import fit_context, count_message_tokens
+from chatbot.guide import guide_cache
+from chatbot.memory import ConversationMemory
+from chatbot.project_store import get_project, PROJECT_CATALOG
+from chatbot.retrieval import retrieve_context, CLASSIFIER_TOKEN_BUDGET, NO_SUPPLEMENTAL_RESOURCES
+from chatbot.singleflight import single_flight, FlightAbandoned, FlightTimeout
+from chatbot.transcript_log import log_sink
+from prompts import context_template
 from utils import ProjectDataException
 
 
+UNRELATED_RESPONSE = "The question does not seem to be related to the project. Please ask a relevant question or contact the online coach."
+UNKNOWN_RESPONSE = "I'm unable to determine the answer to your question. Please rephrase."
+OTHER_WARNING = "I'm not too sure of my answer to this question. Here’s my best attempt..."
+DEGRADED_RESPONSE = "I'm having trouble reaching my knowledge service right now. Please check the project guide on the left, or try again in a minute."
+BUSY_RESPONSE = "I'm getting too many questions right now. Please try again in a minute."
+QUEUE_MESSAGE = "Lots of questions right now, you are number {position} in line. Your answer should start in about {seconds}s."
+THROTTLE_MESSAGE = "You're asking questions quickly! I'll get to this one in about {seconds}s."
+CHAT_RENDER_LIMIT = 30  # messages rendered per rerun; older ones are behind a "Show earlier messages" button
+
+
 def initialize_session_state():
-    if "openai_model" not in st.session_state:
-        st.session_state["openai_model"] = "gpt-3.5-turbo"
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex  # identifies the session in the transcript logs
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        st.session_state.messages = []  # the chat transcript as displayed
+    if "memory" not in st.session_state:
+        st.session_state.memory = ConversationMemory()  # what the model gets to see of the conversation
+    if "combined_classifier" not in st.session_state:
+        # A/B switch between one combined classification call and separate validity + category calls,
+        # overridable per session with ?classifier=combined or ?classifier=separate
+        classifier = st.query_params.get("classifier")
+        st.session_state["combined_classifier"] = COMBINED_CLASSIFIER if classifier is None else classifier == "combined"
+    if "token_usage" not in st.session_state:
+        st.session_state.token_usage = []  # per-call token counts, see record_token_usage
+    if "request_timings" not in st.session_state:
+        st.session_state.request_timings = []  # per-question latency records, see log_request_timings
+    if "chat_render_limit" not in st.session_state:
+        st.session_state.chat_render_limit = CHAT_RENDER_LIMIT
     if "show_chat" not in st.session_state:
         st.session_state["show_chat"] = True  # toggle for collapsible chat panel
 
 
 def get_dropdown_mappings():
-    return {
-        "Grade 5": {
-            "Heat Resistant House": {"key": "heat_resistant_house"},
-            "Community Park": {"key": "community_park"},
-        },
-        "Grade 6": {
-            "News Bulletin": {"key": "news_bulletin"},
-            "Healthy Snack Food": {"key": "healthy_snack_food"},
-        },
-        "Grade 7": {
-            "Healthy, Hyperlocal Restaurant": {"key": "healthy_hyperlocal_restaurant"},
-        },
-        "Grade 8": {
-            "Are We Cleaning Or Polluting?": {"key": "are_we_cleaning_or_polluting"},
-            "Carbon Footprint": {"key": "carbon_footprint"}
-        },
-    }
+    return PROJECT_CATALOG
 
 
-def display_messages(latest_only=False):
-
-    if len(st.session_state.messages) < 2:
-
-        def get_base64_image(image_path):
-            with open(image_path, "rb") as img_file:
-                return base64.b64encode(img_file.read()).decode()
-        image_data = get_base64_image("static/ai_robot.jpg")
-
-        st.markdown(f"""
+@functools.lru_cache(maxsize=None)
+def welcome_markdown():
+    with open("static/ai_robot.jpg", "rb") as img_file:
+        image_data = base64.b64encode(img_file.read()).decode()
+    return f"""
             <div style='text-align: center; display: flex; flex-direction: column; justify-content: center; align-items: center;'>
                 <img src="data:image/png;base64,{image_data}" width="300" style="border-radius: 15px; border: 0px solid gray; max-width: 100%; height: auto;" />
                 <h3 style='color: #1f4760;'>Hi! I'm Akshu.</h3>
                 <p style='font-size: 18px; color: #555;'>I'm here to help you with your project!</p>
             </div>
-        """, unsafe_allow_html=True)
+        """
+
+
+@functools.lru_cache(maxsize=1024)
+def error_markdown(content):
+    return f"""
+                    <div style="background-color: #ffe6e6; padding: 10px; border-radius: 5px; border: 1px solid #ffcccc;">
+                        <p style="color: #cc0000; font-size: 16px; margin: 0;">
+                            {content}
+                        </p>
+                    </div>
+                    """
+
+
+def show_earlier_messages():
+    st.session_state.chat_render_limit += CHAT_RENDER_LIMIT
+
+
+def display_messages(latest_only=False):
+
+    if not st.session_state.messages:
+        st.markdown(welcome_markdown(), unsafe_allow_html=True)
         return
 
     avatars = {"assistant": "💡", "user": "❓", "error": "⚠️"}
 
-    messages = [st.session_state.messages[-1]] if latest_only else st.session_state.messages
+    if latest_only:
+        messages = st.session_state.messages[-1:]
+    else:
+        # Only the most recent messages are rendered on each rerun, so reruns don't slow down as the chat grows
+        hidden = max(0, len(st.session_state.messages) - st.session_state.chat_render_limit)
+        if hidden:
+            st.button(f"Show earlier messages ({hidden})", key="show_earlier_messages", on_click=show_earlier_messages)
+        messages = st.session_state.messages[hidden:]
 
-    for idx, message in enumerate(messages):
+    for message in messages:
         if message.get("error", False):  # Check if the message is an error
             with st.chat_message("assistant", avatar=avatars["error"]):
-                st.markdown(
-                    f"""
-                    <div style="background-color: #ffe6e6; padding: 10px; border-radius: 5px; border: 1px solid #ffcccc;">
-                        <p style="color: #cc0000; font-size: 16px; margin: 0;">
-                            {message["content"]}
-                        </p>
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
+                st.markdown(error_markdown(message["content"]), unsafe_allow_html=True)
         elif message["role"] in ["user", "assistant"]:
             with st.chat_message(message["role"], avatar=avatars[message["role"]]):
                 st.markdown(message["content"])
 
-        if not latest_only:
-            scroll_to_bottom(anchor_id=f"scroll-anchor-{idx}")
-        else:
-            scroll_to_bottom(anchor_id=f'scroll-anchor-{len(st.session_state.messages) - 1}')
+    scroll_to_bottom()
+
+
+def add_message(message):
+    st.session_state.messages.append(message)
+    if message["role"] == "assistant":
+        singleflight.finish(message)  # Sessions waiting on this one for the same question get the same reply
+    log_event("transcript", role=message["role"], content=message["content"], error=message.get("error", False))
+    if not message.get("error", False):
+        st.session_state.memory.add(message["role"], message["content"])
+
+
+def show_warning(text):
+    st.warning(text)
+    singleflight.publish("warning", text)
+
+
+def log_event(kind, **fields):
+    # Queued for the background log writer, never written on the request path
+    log_sink.log(kind, session_id=st.session_state.session_id, project=st.session_state.get("project_key"),
+                 phase=st.session_state.get("project_phase"), **fields)
 
 
 def display_chat_history():
@@ -94,91 +150,360 @@ def display_latest_message():
 
 
 def check_question_validity(client, prompt, context, past_messages):
-    response = client.chat.completions.create(
-        model=st.session_state["openai_model"],
-        messages=[
-            {"role": "system", "content": validity_prompt},
-            {"role": "system", "content": context},
-            {"role": "system", "content": "You have access to the following past messages for context: " + json.dumps(
-                past_messages) if past_messages else ""},
-            {"role": "user", "content": prompt}
-        ],
-    )
-    result = json.loads(response.choices[0].message.content)
+    messages = validity_messages(prompt, context, past_messages)
+    result = validity_tuple(structured.create_json(client, "validity", messages, on_usage=record_token_usage))
     if DEBUG:
-        print(result)
-    return result['prompt'], result["is_valid"], result["language"], result["message"], result["is_default"]
+        log_event("debug", event="validity", result=result)
+    return result
+
+
+def classify_question(client, prompt, context, past_messages):
+    # check_question_validity and get_question_category in a single call
+    messages = classification_messages(prompt, context, past_messages)
+    result = classification_tuple(structured.create_json(client, "classification", messages,
+                                                         on_usage=record_token_usage))
+    if DEBUG:
+        log_event("debug", event="classification", result=result)
+    return result
 
 
 def get_question_category(client, prompt, context):
-    response = client.chat.completions.create(
-        model=st.session_state["openai_model"],
-        messages=[
-            {"role": "system", "content": category_prompt},
-            {"role": "system", "content": context},
-            {"role": "user", "content": prompt},
-        ],
-    )
+    messages = category_messages(prompt, context)
+    result = structured.create_json(client, "category", messages, on_usage=record_token_usage)
     if DEBUG:
-        print(response.choices[0].message.content)
-    return json.loads(response.choices[0].message.content)["category"]
+        log_event("debug", event="category", result=result)
+    return result["category"]
 
 
 def generate_final_response(client, prompt, grade, project_name, project_key, project_phase, language,
-                            question_category, project_driving_question, phase_overview, phase_instructions):
-
-    context_prompt = final_prompt_template.format(
-        grade=grade,
-        project_name=project_name,
-        project_phase=project_phase,
-        category=question_category,
-        language=language,
-        project_driving_question=project_driving_question,
-        phase_overview=phase_overview,
-        phase_instructions=phase_instructions,
-        supplemental_resources='No supplemental resources available.'  # TODO: Placeholder
-    )
+                            question_category, project_driving_question, phase_overview, phase_instructions,
+                            supplemental_resources):
 
-    response = client.chat.completions.create(
-        model=st.session_state["openai_model"],
-        temperature=0.1,
-        messages=[
-            {"role": "system", "content": context_prompt},
-            {"role": "user", "content": prompt},
-        ],
-        stream=False,
-    )
+    context_prompt = final_context_prompt(grade, project_name, project_phase, language, question_category,
+                                          project_driving_question, phase_overview, phase_instructions,
+                                          supplemental_resources)
+
+    messages = final_messages(context_prompt, prompt)
+    response = llm.create(client, "final", messages=messages, stream=False)
+    record_token_usage("final", response, messages)
     if DEBUG:
-        print(response.choices[0].message.content)
+        log_event("debug", event="final", result=response.choices[0].message.content)
     return response.choices[0].message.content.strip()
 
 
-def scroll_to_bottom(anchor_id="scroll-anchor"):
-    html(
-        f"""
-        <div id="{anchor_id}"></div>
-        <script>
-            console.log("Scrolling to anchor: {anchor_id}");
-            setTimeout(function() {{
-                var anchor = document.getElementById("{anchor_id}");
-                if (anchor) {{
-                    anchor.scrollIntoView({{ behavior: 'smooth', block: 'end' }});
-                }} else {{
-                    console.error("Anchor not found: {anchor_id}");
-                }}
-            }}, 100);
-        </script>
-        """,
+def stream_final_response(client, prompt, grade, project_name, project_key, project_phase, language,
+                          question_category, project_driving_question, phase_overview, phase_instructions,
+                          supplemental_resources, timings):
+    """Same as generate_final_response, but yields the answer text as it arrives.
+    Records "final_ttft" (time to first token) and "final_total" in seconds into `timings`."""
+
+    context_prompt = final_context_prompt(grade, project_name, project_phase, language, question_category,
+                                          project_driving_question, phase_overview, phase_instructions,
+                                          supplemental_resources)
+
+    messages = final_messages(context_prompt, prompt)
+    start = time.perf_counter()
+    start_ns = time.time_ns()
+    usage = model = None
+    stream = llm.create(
+        client, "final",
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
     )
+    for chunk in stream:
+        model = model or chunk.model  # As routed by llm.create
+        if chunk.usage:
+            usage = chunk.usage
+            record_token_usage("final", chunk, messages)
+        if chunk.choices and chunk.choices[0].delta.content:
+            if "final_ttft" not in timings:
+                timings["final_ttft"] = time.perf_counter() - start
+            singleflight.publish("chunk", chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+    timings["final_total"] = time.perf_counter() - start
+    tracing.add_span("final", start_ns, model=model, streamed=True,
+                     ttft=timings.get("final_ttft"), prompt_tokens=usage and usage.prompt_tokens,
+                     completion_tokens=usage and usage.completion_tokens)
+
+
+async def answer_concurrently(prompt, context_prompt, past_messages, request_start, usage_start, project_key,
+                              project_context, fast):
+    """The same flow as the sequential branch in main(), on the concurrent pipeline: classification runs alongside a
+    speculative final answer, which is discarded if the question turns out to be invalid, a greeting, unrelated or
+    unknown, and asked for again if the classifier rewrote the prompt or found another language or category than
+    the speculation guessed."""
+    client = llm.async_client(st.secrets["OPENAI_API_KEY"])
+    final_start = time.perf_counter()
+    speculative_language = fast.language or SPECULATIVE_LANGUAGE
+    speculative_context_prompt = final_context_prompt(language=speculative_language,
+                                                      question_category=SPECULATIVE_CATEGORY, **project_context)
+    classification, speculative_answer = await classify_with_speculation(
+        client, prompt, context_prompt, past_messages, speculative_context_prompt,
+        speculative_language, SPECULATIVE_CATEGORY, combined=st.session_state["combined_classifier"],
+        on_usage=record_token_usage)
+    rewritten_prompt, is_valid, language, message, is_default, category_response = classification
+    if DEBUG:
+        log_event("debug", event="classification", result=classification)
+    record_fast_path_agreement(fast, language, is_valid, is_default, category_response)
+
+    if not is_valid:
+        reply, outcome = {"role": "assistant", "error": True, "content": message}, "invalid"
+    elif is_default:
+        reply, outcome = {"role": "assistant", "content": message}, "default"
+    elif 'unrelated' in category_response.lower():
+        reply, outcome = {"role": "assistant", "error": True, "content": UNRELATED_RESPONSE}, "unrelated"
+    elif 'unknown' in category_response.lower():
+        reply, outcome = {"role": "assistant", "error": True, "content": UNKNOWN_RESPONSE}, "unknown"
+    else:
+        reply, outcome = None, "answered"
+    tracing.set_outcome(outcome)
+    if reply is not None:
+        speculative_answer.cancel()
+        add_message(reply)
+        display_latest_message()
+        return
 
+    project_phase = project_context["project_phase"]
+    banked = find_banked_answer(project_key, project_phase, language, rewritten_prompt) if is_follow_up() else None
+    if banked:
+        speculative_answer.cancel()
+        serve_banked_answer(banked, language, request_start)
+        return
+    cached = answer_cache.get(project_key, project_phase, language, rewritten_prompt) if ANSWER_CACHE else None
+    if cached:
+        speculative_answer.cancel()
+        serve_cached_answer(cached)
+        return
+
+    # Only an answer made with the real context may be shown and cached
+    final_answer = speculative_answer
+    if not speculative_answer.matches(rewritten_prompt, language, category_response):
+        speculative_answer.cancel()
+        tracing.root_span().set(speculation="discarded")
+        if rewritten_prompt.strip() != prompt.strip():
+            with tracing.span("context_build", stage="final"):
+                phase_instructions, supplemental_resources = retrieve_context(project_key, project_phase,
+                                                                              rewritten_prompt)
+            project_context = dict(project_context, phase_instructions=phase_instructions,
+                                   supplemental_resources=supplemental_resources)
+        final_context = final_context_prompt(language=language, question_category=category_response,
+                                             **project_context)
+        final_start = time.perf_counter()
+        final_answer = SpeculativeAnswer(client, final_context, rewritten_prompt, record_token_usage,
+                                         language, category_response, speculative=False).start()
+    else:
+        tracing.root_span().set(speculation="used")
+
+    if 'other' in category_response.lower():
+        show_warning(OTHER_WARNING)
+    response = ""
+    with st.chat_message("assistant", avatar="💡"):
+        placeholder = st.empty()
+        async for chunk in final_answer.chunks():
+            response += chunk
+            placeholder.markdown(response)
+            singleflight.publish("chunk", chunk)
+    add_message({"role": "assistant", "content": response.strip()})
+    scroll_to_bottom()
+    log_request_timings(request_start, final_start, final_answer.timings)
+    cache_answer(project_key, project_phase, language, rewritten_prompt, response.strip(), category_response,
+                 usage_start)
+
+
+def answer_fast_path(fast, request_start):
+    # Same replies as the LLM stages give for these verdicts, without calling the LLM
+    tracing.set_outcome(fast.verdict)
+    tracing.root_span().set(fast_path=fast.kind)
+    if fast.kind == "unrelated":
+        reply = {"role": "assistant", "error": True, "content": UNRELATED_RESPONSE}
+    else:
+        reply = {"role": "assistant", "error": fast.verdict == "invalid", "content": fast.message}
+    add_message(reply)
+    display_latest_message()
+    log_event("request", fast_path=fast.kind, language=fast.language, total=time.perf_counter() - request_start)
+
+
+def flight_key(project_key, project_phase, language, prompt):
+    # The same question only gets the same answer if the conversation so far is the same too
+    history = json.dumps(st.session_state.memory.messages(), ensure_ascii=False, sort_keys=True)
+    return (project_key, project_phase.lower(), language, normalize_question(prompt),
+            hashlib.sha256(history.encode("utf-8")).hexdigest())
+
+
+def join_flight(key, request_start):
+    """Lead the flight for this question, or follow the session already answering it and stop the run once its
+    answer is shown. Returns the flight to lead, or None if following took too long and this session answers alone."""
+    while True:
+        flight, leading = single_flight.join(key)
+        if leading:
+            return flight
+        try:
+            follow_flight(flight, request_start)
+        except FlightAbandoned:
+            continue
+        except FlightTimeout:
+            single_flight.count("follower_timeouts")
+            return None
+        st.stop()
+
+
+def follow_flight(flight, request_start):
+    # Show the leading session's reply as it publishes it
+    response, placeholder = "", None
+    try:
+        for kind, value in flight.follow():
+            if kind == "warning":
+                st.warning(value)
+            elif kind == "chunk":
+                if placeholder is None:
+                    placeholder = st.chat_message("assistant", avatar="💡").empty()
+                response += value
+                placeholder.markdown(response)
+            else:
+                add_message(value)
+                if placeholder is None:
+                    display_latest_message()
+                else:
+                    scroll_to_bottom()
+    except (FlightAbandoned, FlightTimeout):
+        if placeholder is not None:
+            placeholder.empty()
+        raise
+    tracing.set_outcome("coalesced")
+    log_event("request", coalesced=True, total=time.perf_counter() - request_start)
+
+
+def admit_question(prompt):
+    """Wait until the rate limits let this question call the API, showing the user their place in the queue, and
+    return its admission ticket. Stops the run with a busy message if the question is shed."""
+    placeholder = st.empty()
+
+    def on_wait(position, seconds):
+        message = THROTTLE_MESSAGE if position is None else QUEUE_MESSAGE
+        placeholder.info(message.format(position=position, seconds=math.ceil(seconds)))
+
+    with tracing.span("admission") as admission_span:
+        try:
+            ticket = admission.admit(st.session_state.session_id, admission.estimate_tokens(prompt), on_wait)
+        except Shed as e:
+            admission_span.set(shed=e.reason)
+            placeholder.empty()
+            tracing.set_outcome("shed")
+            log_event("request", shed=e.reason, admission=admission.stats())
+            add_message({"role": "assistant", "error": True, "content": BUSY_RESPONSE})
+            display_latest_message()
+            st.stop()
+        admission_span.set(waited=ticket.waited, position=ticket.position)
+    placeholder.empty()
+    return ticket
+
+
+def settle_admission(ticket, usage_start):
+    usages = st.session_state.token_usage[usage_start:]
+    tokens = sum((usage["prompt_tokens"] or 0) + (usage["completion_tokens"] or 0) for usage in usages)
+    # Questions that never got a final answer call (cached, banked, unrelated, invalid ...) don't use up a request
+    admission.settle(ticket, tokens, refund_request=not any(usage["stage"] == "final" for usage in usages))
+
+
+def is_follow_up():
+    # Whether the conversation memory holds anything before the question just asked
+    return len(st.session_state.memory.messages()) > 1
+
+
+def find_banked_answer(project_key, project_phase, language, prompt):
+    if not ANSWER_BANK or language is None:
+        return None
+    with tracing.span("answer_bank"):
+        return answer_bank.get(project_key, project_phase, language, prompt)
+
+
+def serve_banked_answer(banked, language, request_start):
+    tracing.set_outcome("banked")
+    question, answer, similarity = banked
+    add_message({"role": "assistant", "content": answer})
+    display_latest_message()
+    log_event("request", answer_bank=question, similarity=similarity, language=language,
+              total=time.perf_counter() - request_start)
+
+
+def record_fast_path_agreement(fast, language, is_valid, is_default, category):
+    log_event("fast_path", **fast_path.record_agreement(fast, language, is_valid, is_default, category))
+
+
+def serve_cached_answer(cached):
+    tracing.set_outcome("cached")
+    answer, category = cached
+    if category and 'other' in category.lower():
+        show_warning(OTHER_WARNING)
+    add_message({"role": "assistant", "content": answer})
+    display_latest_message()
+    if DEBUG:
+        log_event("debug", event="answer_cache", stats=answer_cache.stats())
 
-def render_project_guide(project_key, phase=None):
-    import streamlit as st
-    import yaml
 
-    project_filename = f"./project_data/{project_key}.yml"
-    with open(project_filename, "r", encoding="utf-8") as file:
-        data = yaml.safe_load(file)
+def cache_answer(project_key, project_phase, language, prompt, answer, category, usage_start):
+    # Hits save the category and final calls this answer cost (the validity check runs either way)
+    if not ANSWER_CACHE or not answer:
+        return
+    tokens = sum((usage["prompt_tokens"] or 0) + (usage["completion_tokens"] or 0)
+                 for usage in st.session_state.token_usage[usage_start:] if usage["stage"] in ("category", "final"))
+    answer_cache.put(project_key, project_phase, language, prompt, answer, category, tokens)
+
+
+def record_token_usage(stage, response, messages=None):
+    # "counted_prompt_tokens" is our own count of what we sent, to compare against the API's "prompt_tokens"
+    usage = getattr(response, "usage", None)
+    record = {
+        "stage": stage,
+        "combined_classifier": st.session_state["combined_classifier"],
+        "prompt_tokens": usage.prompt_tokens if usage else None,
+        "completion_tokens": usage.completion_tokens if usage else None,
+        "counted_prompt_tokens": count_message_tokens(messages) if messages else None,
+    }
+    st.session_state.token_usage.append(record)
+    if DEBUG:
+        log_event("debug", event="token_usage", **record)
+
+
+def log_request_timings(request_start, final_start, timings):
+    # ttft and total are measured from when the question was received, so they include the classification calls
+    end = time.perf_counter()
+    record = {
+        "ttft": final_start - request_start + timings.get("final_ttft", end - final_start),
+        "total": end - request_start,
+        "final_ttft": timings.get("final_ttft", end - final_start),
+        "final_total": timings.get("final_total", end - final_start),
+        "streamed": bool(timings),
+        "combined_classifier": st.session_state["combined_classifier"],
+    }
+    st.session_state.request_timings.append(record)
+    log_event("request", **record, llm=llm.metrics(), fast_path=fast_path.stats(), parsing=structured.stats(),
+              coalescing=single_flight.stats(), admission=admission.stats())
+
+
+def scroll_to_bottom():
+    # A single scroll component per page, rewritten in place. Its content only changes when a message is added,
+    # so the iframe is reused (and the script re-run) only when there is something new to scroll to.
+    with st.session_state.scroll_placeholder:
+        html(
+            f"""
+            <script>
+                // {len(st.session_state.messages)} messages
+                setTimeout(function() {{
+                    var messages = window.parent.document.querySelectorAll('[data-testid="stChatMessage"]');
+                    if (messages.length) {{
+                        messages[messages.length - 1].scrollIntoView({{ behavior: 'smooth', block: 'end' }});
+                    }}
+                }}, 100);
+            </script>
+            """,
+            height=0,
+        )
+
+
+def render_project_guide(project_key, phase=None):
+    data = get_project(project_key)
     phases = data.get("phases", {})
     if phase is not None:
         phases = {phase.lower(): phases.get(phase.lower(), {})}
@@ -186,64 +511,12 @@ def render_project_guide(project_key, phase=None):
     st.markdown(f"# 🏗️ {data.get('title', 'Project Title')}")
     st.markdown(f"### ❓ Driving Question\n> {data.get('driving_question', '')}")
 
-    # --- Create a tab for each phase ---
+    # --- Create a tab for each phase, each rendered from its cached markdown ---
     tab_labels = [details.get("name", key.title()) for key, details in phases.items()]
     tabs = st.tabs(tab_labels)
-
-    # --- Render each tab dynamically ---
-    for (key, details), tab in zip(phases.items(), tabs):
+    for key, tab in zip(phases, tabs):
         with tab:
-            st.markdown(f"### ⏱️ Duration: `{details.get('duration', 'N/A')}`")
-
-            if summary := details.get("summary"):
-                with st.expander("📝 Summary", expanded=True):
-                    st.markdown(f"<div style='font-size: 1.1em; line-height: 1.6;'>{summary}</div>",
-                                unsafe_allow_html=True)
-
-            if hook := details.get("story_hook"):
-                with st.expander("🎣 Story Hook"):
-                    if isinstance(hook, list):
-                        for item in hook:
-                            if isinstance(item, dict):
-                                for k, v in item.items():
-                                    st.markdown(f"**{k.capitalize()}:** {v}")
-                            else:
-                                st.markdown(f"- {item}")
-
-            if activities := details.get("activities"):
-                with st.expander("🎯 Activities"):
-                    for act in activities:
-                        st.markdown(f"#### 🔹 {act.get('name')}")
-                        st.markdown(f"{act.get('description', '')}")
-                        if steps := act.get("steps"):
-                            st.markdown("**👣 Steps:**")
-                            for step in steps:
-                                st.markdown(f"- {step}")
-                        if simplifications := act.get("simplifications"):
-                            st.markdown("**🧩 Simplifications:**")
-                            for s in simplifications:
-                                st.markdown(f"- {s}")
-                        if extensions := act.get("extensions"):
-                            if extensions:
-                                st.markdown("**🚀 Extensions:**")
-                                for e in extensions:
-                                    st.markdown(f"- {e}")
-                        st.markdown("---")
-
-            section_info = [
-                ("🧰 Tools & Materials", "tools_materials"),
-                ("🎨 Student Outputs", "student_output"),
-                ("💬 Potential Questions", "potential_questions"),
-                ("🧑‍🏫 Facilitation Notes", "facilitation_notes"),
-                ("📋 General Guidelines", "general_guidelines"),
-            ]
-
-            for section_title, field_key in section_info:
-                items = details.get(field_key)
-                if items:
-                    with st.expander(section_title):
-                        for item in items:
-                            st.markdown(f"- {item}")
+            st.markdown(guide_cache.get(project_key, key), unsafe_allow_html=True)
 
 
 def main(debug=False):
@@ -253,7 +526,7 @@ def main(debug=False):
     st.set_page_config(layout="wide")
     st.set_page_config(page_title="SakshamProjects | Project Guide", page_icon=":book:", initial_sidebar_state="expanded")
     initialize_session_state()
-    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    client = llm.get_client(st.secrets["OPENAI_API_KEY"])
 
     # Layout columns
     col1, col2 = st.columns([2, 1], gap="large")
@@ -272,29 +545,17 @@ def main(debug=False):
                 project_key = dropdown_mappings[grade][project_name]["key"]
                 project_phase = st.selectbox("Select Project Phase",
                                              ["Explore", "Learn", "Design", "Exhibit", "Reflect"])
+                st.session_state.project_key, st.session_state.project_phase = project_key, project_phase
 
-            project_filename = f"./project_data/{project_key}.yml"
             try:
-                with open(project_filename, "r", encoding="utf-8") as file:
-                    project_data = yaml.safe_load(file)
-                    project_driving_question = project_data.get("driving_question", "No driving question found.")
-                    phase_overview = project_data.get("phases", {}).get(project_phase.lower(), {}).get("summary",
-                                                                                                       "No overview found.")
-                    phase_instructions = project_data.get("phases", {}).get(project_phase.lower(), {})
+                with tracing.span("yaml_load", project=project_key):
+                    project_data = get_project(project_key)
+                project_driving_question = project_data.get("driving_question", "No driving question found.")
+                phase_overview = project_data.get("phases", {}).get(project_phase.lower(), {}).get("summary",
+                                                                                                   "No overview found.")
             except Exception as e:
                 raise ProjectDataException(f"Error loading project data: {e}")
 
-            context_prompt = context_template.format(
-                grade=grade,
-                project_name=project_name,
-                project_phase=project_phase,
-                project_driving_question=project_driving_question,
-                phase_overview=phase_overview,
-                phase_instructions=phase_instructions,
-                supplemental_resources='No supplemental resources available.'  # TODO: Placeholder
-            )
-            print(context_prompt)
-
             with st.container(border=False):
                 custom_css = float_css_helper(
                     height="60%",  # Set a fixed height
@@ -305,14 +566,14 @@ def main(debug=False):
                 )
                 float_parent(css=custom_css)
                 # if button_pressed:
-                render_project_guide(project_key, phase=project_phase)
+                with tracing.span("render_guide"):
+                    render_project_guide(project_key, phase=project_phase)
 
     with (col2):
         with st.container():
             if not grade or not project_name or not project_phase:
                 st.error("Please select a grade, project, and project phase to start the chat.")
                 return
-            st.session_state.messages.append({"role": "system", "content": system_prompt})
             prompt = st.chat_input("Ask me anything about your project!", key='chat_input')
             button_css = float_css_helper(bottom="2rem",
                                           height="10%",
@@ -333,53 +594,169 @@ def main(debug=False):
             )
             float_parent(css=custom_css)
 
-            display_chat_history()
+            st.session_state.scroll_placeholder = st.empty()
+            with tracing.span("render_chat", messages=len(st.session_state.messages)):
+                display_chat_history()
 
             if prompt:
-                st.session_state.messages.append({"role": "user", "content": prompt})
+                request_start = time.perf_counter()
+                usage_start = len(st.session_state.token_usage)
+                add_message({"role": "user", "content": prompt})
                 display_latest_message()
 
-                rewritten_prompt, is_valid, language, message, is_default = \
-                    check_question_validity(client, prompt, context_prompt, st.session_state.messages[-10:])
-                if not is_valid:
-                    st.session_state.messages.append({"role": "assistant", "error": True, "content": message})
-                    display_latest_message()
-                    st.stop()
-                else:
-                    if is_default:
-                        st.session_state.messages.append({"role": "assistant", "content": message})
+                flight = ticket = None
+                try:
+                    # Greetings, thanks, injection attempts and obviously off-topic prompts are answered locally.
+                    # With FAST_PATH off the local verdicts are only compared with the LLM's
+                    with tracing.span("fast_path") as fast_path_span:
+                        fast = fast_path.classify(prompt, project_key)
+                        fast_path_span.set(kind=fast.kind, language=fast.language, audited=fast.audited)
+                    if FAST_PATH and fast.decided and not fast.audited:
+                        answer_fast_path(fast, request_start)
+                        st.stop()
+
+                    # The phase's potential_questions were answered ahead of time (python -m chatbot.answer_bank).
+                    # The raw prompt is only matched if it doesn't depend on earlier turns; follow-ups are matched
+                    # once the classifier has rewritten them
+                    if not fast.decided and not is_follow_up():
+                        banked = find_banked_answer(project_key, project_phase, fast.language, prompt)
+                        if banked:
+                            serve_banked_answer(banked, fast.language, request_start)
+                            st.stop()
+
+                    # Sessions asking the same question at the same time share one answer
+                    if COALESCE_QUESTIONS:
+                        flight = join_flight(flight_key(project_key, project_phase, fast.language, prompt),
+                                             request_start)
+
+                    # Questions that will call the API wait their turn under the per-session and global rate limits
+                    if ADMISSION_CONTROL:
+                        ticket = admit_question(prompt)
+
+                    # The classifier gets a small slice of the phase; the final answer gets the chunks most relevant
+                    # to the (rewritten) question plus matching material from the other phases
+                    with tracing.span("context_build", stage="classifier"):
+                        classifier_instructions, _ = retrieve_context(project_key, project_phase, prompt,
+                                                                      phase_token_budget=CLASSIFIER_TOKEN_BUDGET,
+                                                                      supplemental_token_budget=0)
+                        context_prompt, past_messages = fit_context(
+                            "classification" if st.session_state["combined_classifier"] else "validity",
+                            context_template,
+                            dict(grade=grade,
+                                 project_name=project_name,
+                                 project_phase=project_phase,
+                                 project_driving_question=project_driving_question,
+                                 phase_overview=phase_overview,
+                                 phase_instructions=classifier_instructions,
+                                 supplemental_resources=NO_SUPPLEMENTAL_RESOURCES),
+                            st.session_state.memory.messages())
+                    if DEBUG:
+                        log_event("debug", event="context_prompt", content=context_prompt)
+
+                    if CONCURRENT_PIPELINE:
+                        with tracing.span("context_build", stage="final"):
+                            phase_instructions, supplemental_resources = retrieve_context(project_key, project_phase,
+                                                                                          prompt)
+                        project_context = dict(grade=grade, project_name=project_name, project_phase=project_phase,
+                                               project_driving_question=project_driving_question,
+                                               phase_overview=phase_overview, phase_instructions=phase_instructions,
+                                               supplemental_resources=supplemental_resources)
+                        asyncio.run(answer_concurrently(prompt, context_prompt, past_messages, request_start,
+                                                        usage_start, project_key, project_context, fast))
+                        st.stop()
+
+                    if st.session_state["combined_classifier"]:
+                        rewritten_prompt, is_valid, language, message, is_default, category_response = \
+                            classify_question(client, prompt, context_prompt, past_messages)
+                    else:
+                        rewritten_prompt, is_valid, language, message, is_default = \
+                            check_question_validity(client, prompt, context_prompt, past_messages)
+                        category_response = None
+                    if not is_valid or is_default or category_response is not None:
+                        record_fast_path_agreement(fast, language, is_valid, is_default, category_response)
+                    if not is_valid:
+                        tracing.set_outcome("invalid")
+                        add_message({"role": "assistant", "error": True, "content": message})
                         display_latest_message()
                         st.stop()
                     else:
-                        category_response = get_question_category(client, rewritten_prompt, context_prompt)
-                        if 'unrelated' in category_response.lower():
-                            response = "The question does not seem to be related to the project. Please ask a relevant question or contact the online coach."
-                            st.session_state.messages.append({"role": "assistant", "error": True, "content": response})
+                        if is_default:
+                            tracing.set_outcome("default")
+                            add_message({"role": "assistant", "content": message})
                             display_latest_message()
                             st.stop()
-                        elif 'unknown' in category_response.lower():
-                            response = "I'm unable to determine the answer to your question. Please rephrase."
-                            st.session_state.messages.append({"role": "assistant", "error": True, "content": response})
-                            display_latest_message()
-                            st.stop()
-                        elif 'other' in category_response.lower():
-                            st.warning("I'm not too sure of my answer to this question. Here’s my best attempt...")
-
-                        response = generate_final_response(
-                            client=client,
-                            prompt=rewritten_prompt,
-                            grade=grade,
-                            project_name=project_name,
-                            project_key=project_key,
-                            project_phase=project_phase,
-                            language=language,
-                            question_category=category_response,
-                            project_driving_question=project_driving_question,
-                            phase_overview=phase_overview,
-                            phase_instructions=phase_instructions
-                        )
-                        st.session_state.messages.append({"role": "assistant", "content": response})
-                        display_latest_message()
+                        else:
+                            banked = find_banked_answer(project_key, project_phase, language, rewritten_prompt) \
+                                if is_follow_up() else None
+                            if banked:
+                                serve_banked_answer(banked, language, request_start)
+                                st.stop()
+                            cached = answer_cache.get(project_key, project_phase, language, rewritten_prompt) \
+                                if ANSWER_CACHE else None
+                            if cached:
+                                serve_cached_answer(cached)
+                                st.stop()
+                            if category_response is None:
+                                category_response = get_question_category(client, rewritten_prompt, context_prompt)
+                                record_fast_path_agreement(fast, language, is_valid, is_default, category_response)
+                            if 'unrelated' in category_response.lower():
+                                tracing.set_outcome("unrelated")
+                                add_message({"role": "assistant", "error": True, "content": UNRELATED_RESPONSE})
+                                display_latest_message()
+                                st.stop()
+                            elif 'unknown' in category_response.lower():
+                                tracing.set_outcome("unknown")
+                                add_message({"role": "assistant", "error": True, "content": UNKNOWN_RESPONSE})
+                                display_latest_message()
+                                st.stop()
+                            elif 'other' in category_response.lower():
+                                show_warning(OTHER_WARNING)
+                            tracing.set_outcome("answered")
+
+                            with tracing.span("context_build", stage="final"):
+                                phase_instructions, supplemental_resources = retrieve_context(
+                                    project_key, project_phase, rewritten_prompt)
+                            final_response_kwargs = dict(
+                                client=client,
+                                prompt=rewritten_prompt,
+                                grade=grade,
+                                project_name=project_name,
+                                project_key=project_key,
+                                project_phase=project_phase,
+                                language=language,
+                                question_category=category_response,
+                                project_driving_question=project_driving_question,
+                                phase_overview=phase_overview,
+                                phase_instructions=phase_instructions,
+                                supplemental_resources=supplemental_resources
+                            )
+                            if STREAM_FINAL_RESPONSE:
+                                timings = {}
+                                final_start = time.perf_counter()
+                                with st.chat_message("assistant", avatar="💡"):
+                                    response = st.write_stream(stream_final_response(**final_response_kwargs,
+                                                                                     timings=timings))
+                                add_message({"role": "assistant", "content": response.strip()})
+                                scroll_to_bottom()
+                                log_request_timings(request_start, final_start, timings)
+                            else:
+                                final_start = time.perf_counter()
+                                response = generate_final_response(**final_response_kwargs)
+                                add_message({"role": "assistant", "content": response})
+                                display_latest_message()
+                                log_request_timings(request_start, final_start, {})
+                            cache_answer(project_key, project_phase, language, rewritten_prompt, response.strip(),
+                                         category_response, usage_start)
+                except llm.UpstreamUnavailable as e:
+                    tracing.set_outcome("degraded")
+                    log_event("request", error=str(e), llm=llm.metrics(), parsing=structured.stats())
+                    add_message({"role": "assistant", "error": True, "content": DEGRADED_RESPONSE})
+                    display_latest_message()
+                finally:
+                    if ticket is not None:
+                        settle_admission(ticket, usage_start)
+                    if flight is not None:
+                        single_flight.release(flight)
 
 
 st.markdown(
@@ -403,4 +780,13 @@ st.markdown(
 )
 
 DEBUG = True
-main()
+STREAM_FINAL_RESPONSE = True
+COMBINED_CLASSIFIER = True
+CONCURRENT_PIPELINE = True
+ANSWER_CACHE = True
+FAST_PATH = True
+ANSWER_BANK = True
+COALESCE_QUESTIONS = True
+ADMISSION_CONTROL = True
+with tracing.span("rerun"):
+    main()
@@ -0,0 +1,192 @@
+"""Headless Monte Carlo runner for the vertical farm simulator.
+
+Plays N independent games from a strategy spec across a process pool and streams one row per game to CSV or
+Parquet, e.g. for calibrating MARKET_DEMAND_RATIOS and the prices:
+
+    python -m vertical_farm.batch vertical_farm/strategies/example.yml --games 1000 --seed 42 --out results.csv
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+
+import numpy as np
+import yaml
+
+from vertical_farm.data import PLANTS
+from vertical_farm.simulator import (FarmState, GAME_MONTHS, LEVELS, LEVEL_AREA, STARTING_LEVEL_INPUTS,
+                                     simulate_month, make_level_inputs, generate_market_day_customers, make_offer,
+                                     plant_cohort)
+
+PARQUET_BATCH_SIZE = 500
+
+
+def load_strategy(path):
+    """
+    A strategy is a YAML/JSON mapping:
+        environment: {T: 22, H: 60}
+        levels: {Level 1: {N: 3, W: 1500, L: 14}, ...}
+        plantings: {0: {Level 1: {Lettuce: 100}}, every: {Level 2: {Mushroom: 500}}}
+        sell_price_factor: 1.0  # offer = factor * market price, for every customer
+    `plantings` keys are months, or "every" for plantings repeated at the start of every month.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        return yaml.safe_load(file)
+
+
+def _plant(state, level, plant_type, num_plants):
+    # Same checks as the UI's plant_seeds_form; plantings that don't fit the space or budget are skipped
+    plant = PLANTS[plant_type]
+    df_level = state.farm_df[state.farm_df.level == level]
+    used_area = df_level[df_level["status"] == "Growing"]["space"].sum()
+    if num_plants <= 0 or plant["space_required"] * num_plants > LEVEL_AREA - used_area:
+        return
+    if state.budget < plant["seed_cost"] * num_plants:
+        return
+    state.farm_df = plant_cohort(state.farm_df, level, plant_type, state.month * 30, num_plants)
+    new_plants = state.month_changes[state.month]['levels'][level]['new_plants']
+    new_plants[plant_type] = new_plants.get(plant_type, 0) + num_plants
+
+
+def run_game(strategy, months=GAME_MONTHS, seed=None):
+    state = FarmState(months=months) if seed is None else FarmState(months=months, seed=seed)
+    for level in LEVELS:
+        inputs = {**STARTING_LEVEL_INPUTS[level], **strategy.get("environment", {}), **strategy.get("levels", {}).get(level, {})}
+        state.level_inputs[level] = make_level_inputs(level, inputs["T"], inputs["H"], inputs["L"], inputs["W"], inputs["N"])
+    plantings = strategy.get("plantings", {})
+    price_factor = strategy.get("sell_price_factor", 1.0)
+    planted = {x: 0 for x in PLANTS}
+
+    for month in range(months):
+        for key in ("every", month):
+            for level, plants in (plantings.get(key) or {}).items():
+                for plant_type, num_plants in plants.items():
+                    _plant(state, level, plant_type, num_plants)
+        for level in LEVELS:
+            for plant_type, num_plants in state.month_changes[month]['levels'][level]['new_plants'].items():
+                planted[plant_type] += num_plants
+
+        simulate_month(state)
+        generate_market_day_customers(state)
+        for customer in state.customers:
+            item, qty = customer["demand"]
+            make_offer(state, customer, int(state.market_prices[item] * price_factor * qty))
+        state.harvest_store = {x: 0 for x in PLANTS}  # Unsold produce is wasted
+
+    died = {x: 0 for x in PLANTS}
+    harvested = {x: 0 for x in PLANTS}
+    for month_log in state.monthly_logs.values():
+        for entry in month_log:
+            if entry["status"].startswith("Dead"):
+                died[entry["plant"]] += entry["count"]
+            elif entry["status"] == "Harvested":
+                harvested[entry["plant"]] += entry["count"]
+
+    total_cost = sum(x['overall'] for x in state.monthly_costs.values())
+    result = {"revenue": state.revenue, "costs": total_cost, "profit": state.revenue - total_cost,
+              "budget": state.budget}
+    for plant_type in PLANTS:
+        result[f"planted_{plant_type}"] = planted[plant_type]
+        result[f"died_{plant_type}"] = died[plant_type]
+        result[f"harvested_{plant_type}"] = harvested[plant_type]
+    return result
+
+
+def _run_game_task(args):
+    game, strategy, seed_sequence, months = args
+    seed = int.from_bytes(seed_sequence.generate_state(4).tobytes(), "little")
+    return {"game": game, **run_game(strategy, months, seed)}
+
+
+def run_batch(strategy, games, workers=None, seed=None, months=GAME_MONTHS):
+    """Yield one result row per game, in completion order. Every game gets its own seed spawned from `seed`."""
+    tasks = [(i, strategy, seed_sequence, months)
+             for i, seed_sequence in enumerate(np.random.SeedSequence(seed).spawn(games))]
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(_run_game_task, tasks, chunksize=max(1, games // (8 * (workers or os.cpu_count()))))
+
+
+def write_results(rows, path):
+    """Stream result rows to `path` (.csv or .parquet) and return the aggregated summary."""
+    summary = _Summary()
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Writing Parquet needs pyarrow: pip install pyarrow")
+        writer, batch = None, []
+        for row in rows:
+            summary.add(row)
+            batch.append(row)
+            if len(batch) >= PARQUET_BATCH_SIZE:
+                table = pa.Table.from_pylist(batch)
+                writer = writer or pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                batch = []
+        if batch:
+            table = pa.Table.from_pylist(batch)
+            writer = writer or pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        if writer:
+            writer.close()
+    else:
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = None
+            for row in rows:
+                summary.add(row)
+                if writer is None:
+                    writer = csv.DictWriter(file, fieldnames=list(row.keys()))
+                    writer.writeheader()
+                writer.writerow(row)
+                file.flush()
+    return summary.result()
+
+
+class _Summary:
+    def __init__(self):
+        self.profits = []
+        self.planted = {x: 0 for x in PLANTS}
+        self.died = {x: 0 for x in PLANTS}
+
+    def add(self, row):
+        self.profits.append(row["profit"])
+        for plant_type in PLANTS:
+            self.planted[plant_type] += row[f"planted_{plant_type}"]
+            self.died[plant_type] += row[f"died_{plant_type}"]
+
+    def result(self):
+        profits = np.array(self.profits, dtype=float)
+        result = {"games": len(profits)}
+        if len(profits):
+            result.update({"profit_mean": profits.mean(), "profit_std": profits.std(),
+                           **{f"profit_p{q}": np.percentile(profits, q) for q in (5, 25, 50, 75, 95)}})
+        result.update({f"death_rate_{x}": self.died[x] / self.planted[x] for x in PLANTS if self.planted[x]})
+        return result
+
+
+def _game_months(value):
+    months = int(value)
+    if not 1 <= months <= GAME_MONTHS:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {GAME_MONTHS}")
+    return months
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many headless vertical farm games from a strategy spec.")
+    parser.add_argument("strategy", help="Path to a strategy YAML/JSON file")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--months", type=_game_months, default=GAME_MONTHS, help=f"Game length, 1 to {GAME_MONTHS}")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--out", default="results.csv", help="Per-game results, .csv or .parquet")
+    args = parser.parse_args(argv)
+
+    strategy = load_strategy(args.strategy)
+    summary = write_results(run_batch(strategy, args.games, args.workers, args.seed, args.months), args.out)
+    for key, value in summary.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
-import random
+import copy
+import functools
+import hashlib
+from dataclasses import dataclass, field
 
 import numpy as np
-import streamlit as st
+import pandas as pd
 
 from vertical_farm.data import PLANTS, MARKET_DEMAND_RATIOS
 
 STARTING_BUDGET = 10000.0  # Starting budget in Rs.
+GAME_MONTHS = 12  # Length of a game
 LEVELS = ["Level 1", "Level 2", "Level 3"]
 LEVEL_AREA = 10.0  # m^2 per level
 FARM_AREA = LEVEL_AREA * len(LEVELS)  # Total farm area in m^2
@@ -18,7 +22,11 @@ INPUT_VARS_VALUES_LIST = {
     "H": [x for x in range(0, 101, 10)]
 }
 STARTING_ENV_INPUTS = {"T": 24, "H": 50.0}
+LEVEL_ENV_OFFSETS = {LEVELS[0]: -0.1, LEVELS[-1]: 0.1}  # Bottom level runs slightly cooler/drier, top level warmer/more humid
 STARTING_LEVEL_INPUTS = {x: {k: v[0] for k, v in INPUT_VARS_VALUES_LIST.items()} for x in LEVELS}
+# Each farm_df row is a cohort: `count` plants of one type planted together on one level, sharing status and health.
+# `space` is the total area taken by the cohort in m^2.
+FARM_DF_COLUMNS = ["level", "plant", "day_planted", "age", "count", "space", "status", "health"]
 # ---
 AMBIENT_TEMP = 24  # Ambient temperature in degC
 AMBIENT_HUMIDITY = 50.0  # Ambient humidity in %
@@ -33,6 +41,52 @@ MARKET_DEMAND_BASELINE = {plant: FARM_AREA * ratio * PLANTS[plant]['Gmax'] / PLA
 MARKET_DEMAND_RANGES = {plant: (MARKET_DEMAND_BASELINE[plant], MARKET_DEMAND_BASELINE[plant] * 4) for plant, ratio in MARKET_DEMAND_RATIOS.items()}
 
 
+def new_month_changes(months=GAME_MONTHS):
+    # One entry per month of the game, plus the month after the last one that the UI shows at the end
+    return {
+        x: {
+            'environment': {'T': None, 'H': None},
+            'levels': {l: {'N': None, 'W': None, 'L': None, 'new_plants': {}} for l in LEVELS}
+        } for x in range(months + 1)
+    }
+
+
+RNG_STREAMS = ("growth", "disturbance", "market")
+
+
+def seed_from_user_id(user_id):
+    return int.from_bytes(hashlib.sha256(user_id.encode("utf-8")).digest()[:16], "little")
+
+
+def rng_streams(seed, month):
+    # Independent generators for one month of one game, so a replay with the same seed and month is bit-identical
+    seed_sequence = np.random.SeedSequence(seed, spawn_key=(month,))
+    return dict(zip(RNG_STREAMS, (np.random.default_rng(s) for s in seed_sequence.spawn(len(RNG_STREAMS)))))
+
+
+@dataclass
+class FarmState:
+    # Everything one game reads and writes. st.session_state carries the same attributes, so the Streamlit UI passes
+    # the session straight to the functions below and headless runs (vertical_farm.batch) pass a FarmState.
+    seed: int = field(default_factory=lambda: np.random.SeedSequence().entropy)  # See seed_from_user_id
+    months: int = GAME_MONTHS  # Game length
+    month: int = 0
+    budget: float = STARTING_BUDGET
+    revenue: float = 0
+    farm_df: pd.DataFrame = field(default_factory=lambda: pd.DataFrame(columns=FARM_DF_COLUMNS))
+    level_inputs: dict = field(default_factory=lambda: copy.deepcopy(STARTING_LEVEL_INPUTS))
+    month_changes: dict = None  # Sized for `months` by __post_init__
+    harvest_store: dict = field(default_factory=lambda: {x: 0 for x in PLANTS.keys()})
+    market_prices: dict = field(default_factory=dict)
+    monthly_logs: dict = field(default_factory=dict)
+    monthly_costs: dict = field(default_factory=dict)
+    customers: list = field(default_factory=list)
+
+    def __post_init__(self):
+        if self.month_changes is None:
+            self.month_changes = new_month_changes(self.months)
+
+
 def _to_human_readable(var):
     dictionary = {"N": "nutrients", "W": "water", "L": "light", "T": "temperature", "H": "humidity"}
     return dictionary.get(var, var)
@@ -49,62 +103,137 @@ def _format_list(items):
         return f"{', '.join(items[:-1])}, and {items[-1]}"
 
 
-def response(x, ideal, tolerance):
+RESPONSE_BAND_VALUES = [
+    [1.0, 0.99, 0.98, 0.97, 0.96, 0.95],  # Randomly choose between 1.0 and 0.95 for ideal conditions
+    [0.85, 0.86, 0.87, 0.88, 0.89, 0.9, 0.91, 0.92, 0.93, 0.94],  # Randomly choose between 0.85 and 0.9 for near-ideal conditions
+    [0.7, 0.75, 0.8],  # Randomly choose between 0.7 and 0.8 for moderate conditions
+    [0.5],
+]
+
+
+def _response_band(x, ideal, tolerance):
     if abs(x - ideal) <= tolerance:
-        return random.choice([1.0, 0.99, 0.98, 0.97, 0.96, 0.95])  # Randomly choose between 1.0 and 0.95 for ideal conditions
+        return 0
     elif abs(x - ideal) <= 2 * tolerance:
-        return random.choice([0.85, 0.86, 0.87, 0.88, 0.89, 0.9, 0.91, 0.92, 0.93, 0.94])  # Randomly choose between 0.85 and 0.9 for near-ideal conditions
+        return 1
     elif abs(x - ideal) <= 3 * tolerance:
-        return random.choice([0.7, 0.75, 0.8])  # Randomly choose between 0.7 and 0.8 for moderate conditions
+        return 2
     else:
-        return 0.5
+        return 3
+
+
+def _adverse_excess(x, ideal, tolerance):
+    # How far x is outside the ideal band, in multiples of the tolerance (0.0 when inside the band)
+    if (ideal - tolerance) <= x <= (ideal + tolerance):
+        return 0.0
+    if x > ideal:
+        return abs(x - (ideal + tolerance)) / tolerance
+    return abs((ideal - tolerance) - x) / tolerance
+
+
+# --- Precomputed lookup tables, indexed by (plant, input variable, setting index) ---
+# Settings are every value in INPUT_VARS_VALUES_LIST, plus the level offsets for temperature and humidity.
+PLANT_INDEX = {name: i for i, name in enumerate(PLANTS)}
+SETTING_VALUES = {
+    var: sorted({round(v + (offset if var in ("T", "H") else 0.0), 1)
+                 for v in values for offset in [0.0, *LEVEL_ENV_OFFSETS.values()]})
+    for var, values in INPUT_VARS_VALUES_LIST.items()
+}
+SETTING_INDEX = {var: {v: i for i, v in enumerate(values)} for var, values in SETTING_VALUES.items()}
+
 
+def _build_env_tables():
+    shape = (len(PLANTS), len(INPUT_VARS), max(len(values) for values in SETTING_VALUES.values()))
+    bands = np.full(shape, -1, dtype=np.int8)  # index into RESPONSE_BAND_VALUES
+    excess = np.zeros(shape)  # > 0 means the variable is adverse for the plant
+    for name, p in PLANT_INDEX.items():
+        ideal, tolerance = PLANTS[name]["ideal"], PLANTS[name]["tolerance"]
+        for v, var in enumerate(INPUT_VARS):
+            for i, x in enumerate(SETTING_VALUES[var]):
+                bands[p, v, i] = _response_band(x, ideal[var], tolerance[var])
+                excess[p, v, i] = _adverse_excess(x, ideal[var], tolerance[var])
+    return bands, excess
 
-def plant_health_score(plant, env):
-    min_r = 1.0
-    for var in INPUT_VARS:
-        r = response(env[var], plant["ideal"][var], plant["tolerance"][var])
-        if r < min_r:
-            min_r = r
-    return min_r
+
+RESPONSE_BAND_TABLE, ADVERSE_EXCESS_TABLE = _build_env_tables()
+_VAR_POSITIONS = np.arange(len(INPUT_VARS))
+
+
+def evaluate_env(plant, env):
+    # Response band and adverse excess of each input variable for this plant, looked up from the precomputed tables
+    try:
+        settings = [SETTING_INDEX[var][round(env[var], 1)] for var in INPUT_VARS]
+    except KeyError:  # Off-grid setting, fall back to computing directly
+        return (np.array([_response_band(env[var], plant["ideal"][var], plant["tolerance"][var]) for var in INPUT_VARS]),
+                np.array([_adverse_excess(env[var], plant["ideal"][var], plant["tolerance"][var]) for var in INPUT_VARS]))
+    p = PLANT_INDEX[plant["name"]]
+    return RESPONSE_BAND_TABLE[p, _VAR_POSITIONS, settings], ADVERSE_EXCESS_TABLE[p, _VAR_POSITIONS, settings]
+
+
+def response(x, ideal, tolerance, rng):
+    return rng.choice(RESPONSE_BAND_VALUES[_response_band(x, ideal, tolerance)])
+
+
+def plant_health_score(plant, env, rng):
+    bands, _ = evaluate_env(plant, env)
+    return min(rng.choice(RESPONSE_BAND_VALUES[band]) for band in bands)
+
+
+@functools.lru_cache(maxsize=None)
+def _score_distribution(bands):
+    band_values = [np.asarray(RESPONSE_BAND_VALUES[band]) for band in bands]
+    scores = np.unique(np.concatenate(band_values))
+    at_least = np.ones(len(scores))  # P(score >= s) for each s in scores
+    for values in band_values:
+        at_least *= (values[None, :] >= scores[:, None]).mean(axis=1)
+    return scores, at_least - np.append(at_least[1:], 0.0)
+
+
+def health_score_distribution(plant, env):
+    # Exact distribution of plant_health_score for this env: the distinct scores (ascending) and their probabilities
+    bands, _ = evaluate_env(plant, env)
+    return _score_distribution(tuple(int(band) for band in bands))
 
 
 def get_plant_yield(plant, health_score):
     return round(plant["Gmax"] * health_score, 4)
 
 
-def simulate_disturbance(plant, env):
+def disturbance_probability(plant, env):
     # Find disturbance probability based on plant type and environment
-    max_percent_difference = 0
-    adverse_variables = []
-
-    for var in INPUT_VARS:
-        if (plant['ideal'][var] - plant['tolerance'][var]) <= env[var] <= (
-                plant['ideal'][var] + plant['tolerance'][var]):
-            continue
-        adverse_variables.append(var)
-        if env[var] > plant['ideal'][var]:
-            percent_difference = abs(env[var] - (plant["ideal"][var] + plant['tolerance'][var])) / plant["tolerance"][var]
-        else:
-            percent_difference = abs((plant["ideal"][var] - plant['tolerance'][var]) - env[var]) / plant["tolerance"][var]
-        if percent_difference > max_percent_difference:
-            max_percent_difference = percent_difference
-    return np.random.rand() > (1.0 - ((max_percent_difference**2) * 0.1)), adverse_variables
-
-
-def calculate_month_cost():
+    _, excess = evaluate_env(plant, env)
+    adverse_variables = [var for var, x in zip(INPUT_VARS, excess) if x > 0]
+    return (float(excess.max())**2) * 0.1, adverse_variables
+
+
+def simulate_disturbance(plant, env, rng):
+    probability, adverse_variables = disturbance_probability(plant, env)
+    return rng.random() > (1.0 - probability), adverse_variables
+
+
+def make_level_inputs(level, temperature, humidity, lighting, water, nutrients):
+    return {
+        "L": lighting,
+        "W": water,
+        "N": nutrients,
+        "T": temperature + LEVEL_ENV_OFFSETS.get(level, 0.0),
+        "H": humidity + LEVEL_ENV_OFFSETS.get(level, 0.0)
+    }
+
+
+def calculate_month_cost(state):
     seed_costs = 0
     elec_costs = 0
     water_costs = 0
     nutrients_costs = 0
     rent_costs = RENT
     for level in LEVELS:
-        new_plants = st.session_state.month_changes[st.session_state.month]['levels'][level]['new_plants']
+        new_plants = state.month_changes[state.month]['levels'][level]['new_plants']
         for plant in new_plants:
             plant_info = PLANTS[plant]
             seed_costs += plant_info["seed_cost"] * new_plants[plant]
     for level in LEVELS:
-        env = STARTING_LEVEL_INPUTS[level]
+        env = state.level_inputs[level]
         elec_costs += round(PRICE_L_PER_DLI_PER_M2_PER_MONTH * LEVEL_AREA * env['L'])  # 0.0648 KWh / DLI / m^2 / month * Rs.2 per KWh
         # elec_costs += round(PRICE_T_PER_DEG_C_PER_M2_PER_MONTH * LEVEL_AREA * abs(env['T'] - AMBIENT_TEMP))  # 1 Rs. / degC / m^2 / month
         # elec_costs += round(PRICE_H_PER_PERCENT_RH_PER_M2_PER_MONTH * LEVEL_AREA * abs(env['H'] - AMBIENT_HUMIDITY))  # 1 Rs. / %RH / m^2 / month
@@ -116,62 +245,98 @@ def calculate_month_cost():
     return month_cost, rent_costs, seed_costs, elec_costs, water_costs, nutrients_costs
 
 
-def simulate_month():
-    updates = []
-    monthly_update = []
-
+def plant_cohort(farm_df, level, plant_type, day_planted, count):
+    # Add `count` seeds to the farm, topping up this month's cohort of the same plant on the same level if there is one
+    space = PLANTS[plant_type]["space_required"] * count
+    same_cohort = ((farm_df["level"] == level) & (farm_df["plant"] == plant_type) & (farm_df["day_planted"] == day_planted)
+                   & (farm_df["age"] == 0) & (farm_df["status"] == "Growing") & (farm_df["health"] == 1.0))
+    if same_cohort.any():
+        idx = farm_df.index[same_cohort][0]
+        farm_df.at[idx, "count"] += count
+        farm_df.at[idx, "space"] += space
+        return farm_df
+    new_row = {
+        "level": level,
+        "plant": plant_type,
+        "day_planted": day_planted,
+        "age": 0,
+        "count": count,
+        "space": space,
+        "status": "Growing",
+        "health": 1.0  # Initial health is 100%
+    }
+    return pd.concat([farm_df, pd.DataFrame([new_row], columns=FARM_DF_COLUMNS)], ignore_index=True)
+
+
+def simulate_month(state):
     # Remove plants that are not growing anymore
-    st.session_state.farm_df.drop(index=st.session_state.farm_df[st.session_state.farm_df["status"] != "Growing"].index,
+    state.farm_df.drop(index=state.farm_df[state.farm_df["status"] != "Growing"].index,
                                     axis=0, inplace=True)
 
     # Generate market prices for all plants
-    generate_market_prices()
+    generate_market_prices(state)
 
     # Calculate the monthly costs
-    month_cost, rent_cost, seeds_cost, elec_cost, water_cost, nutrients_cost = calculate_month_cost()
+    month_cost, rent_cost, seeds_cost, elec_cost, water_cost, nutrients_cost = calculate_month_cost(state)
 
     # Increment the age of all plants by one month
-    st.session_state.farm_df.loc[:, "age"] += 30
-
-    # Simulate plant growth and disturbances
-    for idx, row in st.session_state.farm_df.iterrows():
-        if row["status"] == "Growing":
-            plant = PLANTS[row["plant"]]
-            env = STARTING_LEVEL_INPUTS[row["level"]].copy()
-            dead, adverse_variables = simulate_disturbance(plant, env)
-            if dead:
-                reasons = [_to_human_readable(x) for x in adverse_variables]
-                updates.append((idx, f"Dead - Unbalanced {_format_list(reasons)}", 0.0, 0))
-            elif row["age"] >= plant["growth_days"]:
-                yield_kg = get_plant_yield(plant, row["health"])
-                st.session_state.harvest_store[row["plant"]] += yield_kg
-                updates.append((idx, "Harvested", row["health"], 0))
+    state.farm_df.loc[:, "age"] += 30
+
+    rng = rng_streams(state.seed, state.month)
+    cohorts = []
+
+    # Simulate plant growth and disturbances, one pass per (plant, level) group drawing counts for whole cohorts
+    for (plant_name, level), group in state.farm_df.groupby(["plant", "level"], sort=False):
+        plant = PLANTS[plant_name]
+        env = state.level_inputs[level].copy()
+        probability, adverse_variables = disturbance_probability(plant, env)
+        dead_status = f"Dead - Unbalanced {_format_list([_to_human_readable(x) for x in adverse_variables])}"
+        scores, score_probabilities = health_score_distribution(plant, env)
+
+        counts = group["count"].to_numpy(dtype=int)
+        dead_counts = rng['disturbance'].binomial(counts, min(probability, 1.0))
+        harvested = group["age"].to_numpy(dtype=float) >= plant["growth_days"]
+
+        for row, dead_count, alive_count, is_harvested in zip(group.itertuples(index=False), dead_counts,
+                                                              counts - dead_counts, harvested):
+            if dead_count:
+                cohorts.append((row, dead_status, 0.0, dead_count))
+            if not alive_count:
+                continue
+            if is_harvested:
+                state.harvest_store[plant_name] += float(get_plant_yield(plant, row.health) * alive_count)
+                cohorts.append((row, "Harvested", row.health, alive_count))
             else:
-                health_score = plant_health_score(plant, env)
-                updates.append((idx, "Growing", round(health_score * row["health"], 2), 0))
-
-    for k, v in st.session_state.harvest_store.items():
-        st.session_state.harvest_store[k] = round(v, 0)
-
-    st.session_state.budget -= month_cost
-
-    # Update the farm DataFrame and monthly logs
-    for idx, status, health, reward in updates:
-        st.session_state.farm_df.at[idx, "status"] = status
-        st.session_state.budget += reward
-        monthly_update.append(
-            {"plant": st.session_state.farm_df.at[idx, "plant"], "level": st.session_state.farm_df.at[idx, "level"],
-             "status": status, "health": health, "revenue": reward})
-    st.session_state.monthly_logs[st.session_state.month] = monthly_update
-    st.session_state.monthly_costs[st.session_state.month] = {"rent": rent_cost, "seeds": seeds_cost,
+                for score, count in zip(scores, rng['growth'].multinomial(alive_count, score_probabilities)):
+                    if count:
+                        cohorts.append((row, "Growing", round(score * row.health, 2), count))
+
+    for k, v in state.harvest_store.items():
+        state.harvest_store[k] = round(v, 0)
+
+    state.budget -= month_cost
+
+    # Update the farm DataFrame and monthly logs, merging cohorts that ended up identical
+    farm_df = pd.DataFrame(
+        [(row.level, row.plant, row.day_planted, row.age, int(count), PLANTS[row.plant]["space_required"] * count,
+          status, float(health)) for row, status, health, count in cohorts],
+        columns=FARM_DF_COLUMNS)
+    farm_df = farm_df.groupby(["level", "plant", "day_planted", "age", "status", "health"], sort=False,
+                              as_index=False)[["count", "space"]].sum()[FARM_DF_COLUMNS]
+    farm_df["revenue"] = 0
+    state.budget += farm_df["revenue"].sum()
+    state.monthly_logs[state.month] = \
+        farm_df[["plant", "level", "status", "health", "count", "revenue"]].to_dict("records")
+    state.farm_df = farm_df.drop(columns=["revenue"])
+    state.monthly_costs[state.month] = {"rent": rent_cost, "seeds": seeds_cost,
         "electricity": elec_cost, "water": water_cost, "nutrients": nutrients_cost, 'overall': month_cost}
 
     # Increment the month
-    st.session_state.month += 1
+    state.month += 1
     return
 
 
-def generate_market_prices():
+def generate_market_prices(state):
     # Calculate cost per kg of plant
     for name, plant in PLANTS.items():
         yield_per_m2 = plant['Gmax'] / plant[
@@ -183,21 +348,24 @@ def generate_market_prices():
             plant['growth_days'] / 30, 0)
         total_cost_per_m2 = elec_cost_per_m2 + water_cost_per_m2 + nutrients_cost_per_m2
         total_cost_per_kg = round((total_cost_per_m2 / yield_per_m2) + plant['supply_chain_cost_per_kg'], 0)
-        st.session_state.market_prices[name] = round(total_cost_per_kg * 1.4, 0)
+        state.market_prices[name] = round(total_cost_per_kg * 1.4, 0)
 
 
-def generate_market_day_customers():
+def generate_market_day_customers(state):
+    rng = rng_streams(state.seed, state.month)['market']
 
     def split_number_into_chunks(total, chunks=3):
-        cuts = sorted(random.sample(range(1, total), chunks - 1))
+        cuts = sorted(int(x) for x in rng.choice(np.arange(1, total), size=chunks - 1, replace=False))
         cuts = [0] + cuts + [total]
         return [cuts[i + 1] - cuts[i] for i in range(chunks)]
 
+    customer_icons = ["👩", "👨", "👵", "👴", "👩‍🌾", "👨‍🌾", "👩‍🍳", "👨‍🍳", "👩‍💼",
+                      "👨‍💼", "👩‍🎓", "👨‍🎓", "👩‍🔧", "👨‍🔧", "👩‍💻", "👨‍💻"]
     market_demand = {}
     demand_of_each_customer = {}
     for item in MARKET_DEMAND_RANGES:
-        market_demand[item] = int(np.random.uniform(low=MARKET_DEMAND_RANGES[item][0], high=MARKET_DEMAND_RANGES[item][1]))
-        demand_of_each_customer[item] = split_number_into_chunks(market_demand[item], random.choice([2, 3, 4]))
+        market_demand[item] = int(rng.uniform(low=MARKET_DEMAND_RANGES[item][0], high=MARKET_DEMAND_RANGES[item][1]))
+        demand_of_each_customer[item] = split_number_into_chunks(market_demand[item], int(rng.choice([2, 3, 4])))
 
     customers = []
     i = 0
@@ -205,16 +373,29 @@ def generate_market_day_customers():
         customer_values = demand_of_each_customer[item]
         for cv in customer_values:
             i += 1
-            customer_icon = random.choice(["👩", "👨", "👵", "👴", "👩‍🌾", "👨‍🌾", "👩‍🍳", "👨‍🍳", "👩‍💼",
-                                       "👨‍💼", "👩‍🎓", "👨‍🎓", "👩‍🔧", "👨‍🔧", "👩‍💻", "👨‍💻"])
+            customer_icon = customer_icons[rng.integers(len(customer_icons))]
             customer = {
                 "id": i + 1,
                 "icon": customer_icon,
                 "demand": (item, cv),
-                "max_price": int(st.session_state.market_prices[item] * np.random.uniform(low=0.90, high=1.15) * cv),
+                "max_price": int(state.market_prices[item] * rng.uniform(low=0.90, high=1.15) * cv),
                 "accepted": False
             }
             customers.append(customer)
 
-    random.shuffle(customers)
-    st.session_state.customers = customers
\ No newline at end of file
+    state.customers = [customers[i] for i in rng.permutation(len(customers))]
+
+
+def make_offer(state, customer, offer):
+    # Offer `offer` Rs. for the customer's whole demand. Returns "accepted", "rejected" or "skipped" (not enough stock)
+    customer['accepted'] = False
+    item, qty = customer["demand"]
+    if state.harvest_store.get(item, 0) < qty:
+        return "skipped"
+    if offer > customer["max_price"]:
+        return "rejected"
+    state.revenue += offer
+    state.budget += offer
+    state.harvest_store[item] -= qty
+    customer['accepted'] = True
+    return "accepted"
@@ -10,20 +10,19 @@ from anyio import create_udp_socket
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from vertical_farm.data import PLANTS, ITEM_ICONS
-from vertical_farm.simulator import simulate_month, STARTING_BUDGET, LEVELS, LEVEL_AREA, INPUT_VARS_VALUES_LIST, STARTING_LEVEL_INPUTS, STARTING_ENV_INPUTS, generate_market_day_customers
+from vertical_farm.simulator import simulate_month, plant_cohort, make_offer, new_month_changes, seed_from_user_id, FARM_DF_COLUMNS, STARTING_BUDGET, LEVELS, LEVEL_AREA, INPUT_VARS_VALUES_LIST, STARTING_LEVEL_INPUTS, STARTING_ENV_INPUTS, make_level_inputs, generate_market_day_customers
 from vertical_farm.ui_callbacks import _update_monthly_changes, _disable_simulate, _check_justifications
 
 
 def initialize_session_state():
     if "user_id" not in st.session_state:
         st.session_state.user_id = str(uuid.uuid4())
+        st.session_state.seed = seed_from_user_id(st.session_state.user_id)
         st.session_state.screen = "farm"
         st.session_state.month = 0
         st.session_state.monthly_costs = dict()
         st.session_state.budget = STARTING_BUDGET
-        st.session_state.farm_df = pd.DataFrame(columns=[
-            "level", "plant", "day_planted", "age", "space", "status", "health"
-        ])
+        st.session_state.farm_df = pd.DataFrame(columns=FARM_DF_COLUMNS)
         st.session_state.STARTING_ENV_INPUTS = STARTING_ENV_INPUTS
         st.session_state.STARTING_LEVEL_INPUTS = STARTING_LEVEL_INPUTS
         st.session_state.market_prices = dict()
@@ -34,12 +33,8 @@ def initialize_session_state():
                 'levels': STARTING_LEVEL_INPUTS.copy(),
                 'env': STARTING_ENV_INPUTS.copy()
             }
-        st.session_state.month_changes = {
-            x:{
-                'environment': {'T': None, 'H': None},
-                'levels': {l: {'N': None, 'W': None, 'L': None, 'new_plants': {}} for l in LEVELS}
-            } for x in range(13)
-        }
+        st.session_state.level_inputs = STARTING_LEVEL_INPUTS
+        st.session_state.month_changes = new_month_changes()
         st.session_state._environment_controls_expanded = False
         st.session_state._inputs_expanded = {l: False for l in LEVELS}
         st.session_state._plant_seeds_expanded = {l: False for l in LEVELS}
@@ -145,20 +140,8 @@ def market_day_screen():
 
     with col2:
         if st.button("➤ Submit Offer", key=f"submit_{idx}", disabled=st.session_state.customer_offer_submitted):
-            customer['accepted'] = False
-            st.session_state.enough = st.session_state.harvest_store.get(customer_item, 0) >= customer_qty
-            if st.session_state.enough:
-                accepted = offer <= customer["max_price"]
-                if accepted:
-                    st.session_state.customer_offer_result = "accepted"
-                    st.session_state.revenue += offer
-                    st.session_state.budget += offer
-                    customer['accepted'] = True
-                    st.session_state.harvest_store[customer_item] -= customer_qty
-                else:
-                    st.session_state.customer_offer_result = "rejected"
-            else:
-                st.session_state.customer_offer_result = "skipped"
+            st.session_state.customer_offer_result = make_offer(st.session_state, customer, offer)
+            st.session_state.enough = st.session_state.customer_offer_result != "skipped"
 
             st.session_state.customer_offer_submitted = True
             st.rerun()
@@ -246,11 +229,9 @@ def this_month_results(expanded=True):
             month_log = st.session_state.monthly_logs.get(this_month, [])
             if month_log:
                 df_log = pd.DataFrame(month_log)
-                summary = df_log.groupby("plant").agg(
-                    died=("status", lambda x: (x.str.contains("Dead")).sum()),
-                    harvested=("status", lambda x: (x == "Harvested").sum()),
-                    revenue=("revenue", "sum")
-                )
+                df_log["died"] = df_log["count"].where(df_log["status"].str.contains("Dead"), 0)
+                df_log["harvested"] = df_log["count"].where(df_log["status"] == "Harvested", 0)
+                summary = df_log.groupby("plant")[["died", "harvested", "revenue"]].sum()
                 st.dataframe(summary)
                 st.markdown("**Total Monthly Cost**: ₹{:.2f}".format(st.session_state.monthly_costs.get(this_month, 0.0)['overall']))
                 st.markdown("Rent: ₹{:.2f}".format(st.session_state.monthly_costs.get(this_month, 0.0)['rent']))  # Assuming half for rent
@@ -280,37 +261,27 @@ def control_panel():
             plant_seeds_form(level, used_area)
             STARTING_ENV_INPUTS["T"] = temperature
             STARTING_ENV_INPUTS["H"] = humidity
-            STARTING_LEVEL_INPUTS[level] = {
-                "L": lighting,
-                "W": water,
-                "N": nutrients,
-                "T": (temperature - 0.1) if level == LEVELS[0] else (temperature + 0.1) if level == LEVELS[
-                    -1] else temperature,
-                "H": (humidity - 0.1) if level == LEVELS[0] else (humidity + 0.1) if level == LEVELS[
-                    -1] else humidity
-            }
+            STARTING_LEVEL_INPUTS[level] = make_level_inputs(level, temperature, humidity, lighting, water, nutrients)
             df_sorted = df_level.copy()
             df_sorted["status_order"] = df_sorted["status"].map({"Growing": 0, "Harvested": 1, "Dead": 2})
             df_sorted = df_sorted.sort_values("status_order")
             df_sorted["select"] = False
-            df_sorted = df_sorted.reset_index(drop=True)
             df_sorted["health"] = df_sorted["health"].apply(lambda x: f"{x * 100:.0f}%")
             edited_df = st.data_editor(
                 df_sorted.drop(columns=["status_order"]),
                 key=f"editor_{level}",
                 num_rows="dynamic",
                 use_container_width=True,
-                column_order=["select", "plant", "status", "health", "age"],
-                disabled=["plant", "status", "health", "age"],
+                column_order=["select", "plant", "count", "status", "health", "age"],
+                disabled=["plant", "count", "status", "health", "age"],
                 hide_index=True
             )
             selected = edited_df[edited_df["select"]].index.tolist()
             if selected:
                 if st.button("Remove Selected Plants", key=f"delete_rows_{level}"):
                     st.session_state.farm_df.drop(index=selected, inplace=True)
-                    removed_types = edited_df.loc[selected, "plant"].unique()
-                    for plant_type in removed_types:
-                        num_plants = edited_df.loc[selected, "plant"].value_counts().get(plant_type, 0)
+                    removed_counts = edited_df.loc[selected].groupby("plant")["count"].sum()
+                    for plant_type, num_plants in removed_counts.items():
                         if num_plants > 0:
                             _update_monthly_changes(level=level, type='removed_plants', plant=plant_type, num_plants=num_plants)
                     st.rerun()
@@ -415,17 +386,9 @@ def plant_seeds_form(level, used_area):
                 elif st.session_state.budget < plant["seed_cost"] * num_plants:
                     st.error("Insufficient budget to plant these seeds.")
                 else:
-                    for _ in range(num_plants):
-                        new_row = {
-                            "level": level,
-                            "plant": plant_type,
-                            "day_planted": st.session_state.month * 30,
-                            "age": 0,
-                            "space": plant["space_required"],
-                            "status": "Growing",
-                            "health": 1.0  # Initial health is 100%
-                        }
-                        st.session_state.farm_df = pd.concat([st.session_state.farm_df, pd.DataFrame([new_row])], ignore_index=True)
+                    if num_plants > 0:
+                        st.session_state.farm_df = plant_cohort(st.session_state.farm_df, level, plant_type,
+                                                                st.session_state.month * 30, num_plants)
                     _update_monthly_changes(level=level, type='new_plants', plant=plant_type, num_plants=num_plants)
                     st.success(f"Planted {num_plants} {plant_type} seeds on {level}!")
                     st.rerun()
@@ -512,7 +475,7 @@ def main():
                 simulate_button = st.button("End Game 🚩", key="simulate_complete", disabled=simulate_disabled)
 
             if simulate_button:
-                simulate_month()
+                simulate_month(st.session_state)
                 st.success("Month simulated!")
                 st.session_state["_just_simulated"] = True
                 st.session_state.month_start_state = {
@@ -520,7 +483,7 @@ def main():
                     'env': st.session_state.STARTING_ENV_INPUTS.copy(),
                     'levels': st.session_state.STARTING_LEVEL_INPUTS.copy(),
                 }
-                generate_market_day_customers()
+                generate_market_day_customers(st.session_state)
                 st.session_state.simulate_disabled = True
                 st.rerun()
 